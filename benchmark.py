@@ -0,0 +1,80 @@
+# Universal SDR waterfall image saver.
+# (c) 2017 Dmitrii (dmitryelj@gmail.com)
+#
+# DSP throughput benchmark, no receiver required.
+# Usage: python3 benchmark.py [--imagewidth=4096] [--average=64] [--lines=20]
+
+import numpy as np
+import optparse
+import time
+import imageProcessing
+import signalProcessing
+import utils
+
+def makeFrames(imageWidth, count):
+    data = np.random.randn(count, imageWidth) + 1j*np.random.randn(count, imageWidth)
+    return data*100
+
+def benchmarkLoop(imageWidth, average, lines):
+    # Per-frame applyFFT in Python loop, as it was used in wf2img
+    frames = makeFrames(imageWidth, average)
+    t_start = time.perf_counter()
+    for l in range(lines):
+        fftData = np.zeros(imageWidth)
+        for p in range(average):
+            fft = imageProcessing.applyFFT(frames[p], imageWidth)
+            fft[0] = fft[1]
+            fftData += fft
+        fftData /= average
+    return time.perf_counter() - t_start
+
+def benchmarkBatch(imageWidth, average, lines, dtype=np.complex128, spectrumType='fft'):
+    # All frames of the line in one batched call
+    spectrum = imageProcessing.SpectrumAverager(imageWidth, average, dtype=dtype, spectrumType=spectrumType)
+    frames = makeFrames(spectrum.frameSize, average).astype(dtype)
+    t_start = time.perf_counter()
+    for l in range(lines):
+        for p in range(average):
+            spectrum.addFrame(frames[p])
+        fftData = spectrum.getSpectrum()
+        fftData[0] = fftData[1]
+    return time.perf_counter() - t_start
+
+def printResult(name, samples, seconds):
+    print("{:<24} {:8.1f} ms {:8.2f} MS/s".format(name, 1000*seconds, samples/seconds/1e6))
+
+if __name__ == '__main__':
+    print(utils.bold('SDR Waterfall2Img DSP benchmark'))
+
+    parser = optparse.OptionParser()
+    parser.add_option("--imagewidth", dest="imagewidth", help="image width", default=4096)
+    parser.add_option("--average", dest="average", help="FFT average", default=64)
+    parser.add_option("--lines", dest="lines", help="lines to process", default=20)
+    options, args = parser.parse_args()
+
+    imageWidth = imageProcessing.getNearestImageWidth(int(options.imagewidth))
+    average = int(options.average)
+    lines = int(options.lines)
+    samples = imageWidth*average*lines
+
+    print("Image width:", imageWidth)
+    print("Average:", average)
+    print("Lines:", lines)
+    print("")
+
+    printResult("Per-frame FFT loop", samples, benchmarkLoop(imageWidth, average, lines))
+    printResult("Batched FFT", samples, benchmarkBatch(imageWidth, average, lines))
+    printResult("Batched FFT, float32", samples, benchmarkBatch(imageWidth, average, lines, np.complex64))
+    printResult("Batched PFB, 4 taps", samples, benchmarkBatch(imageWidth, average, lines, spectrumType='pfb'))
+    printResult("Batched PFB, float32", samples, benchmarkBatch(imageWidth, average, lines, np.complex64, 'pfb'))
+
+    line = np.random.rand(imageWidth)*512
+    t_start = time.perf_counter()
+    for l in range(lines):
+        imageProcessing.generateNewLine(imageWidth, line, 8)
+    printResult("Colour mapping", imageWidth*average*lines, time.perf_counter() - t_start)
+
+    print("")
+    results = signalProcessing.selectFastestFFTBackend(imageWidth, average)
+    for name, t in results.items():
+        printResult("FFT backend {}".format(name), imageWidth*average, t)
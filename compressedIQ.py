@@ -0,0 +1,225 @@
+# Universal SDR IQ/waterfall image saver.
+# (c) 2017 Dmitrii (dmitryelj@gmail.com)
+#
+# Compressed IQ container (.iqz): fixed-size chunks compressed independently, chunk index at the end.
+#
+# Layout: magic, metadata length (uint32), metadata (JSON),
+#         chunks: compressed size (uint32), samples (uint32), compressed data,
+#         index: offset (uint64), compressed size (uint32), samples (uint32) for each chunk,
+#         trailer: index offset (uint64), chunks count (uint64), index magic.
+# If the recording was interrupted (no index), chunks are found by their headers.
+
+import numpy as np
+import os, time, struct, json, zlib
+import concurrent.futures
+import collections
+# zstandard is optional, zlib is always available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+IQZ_MAGIC = b'WFIQZ\x00\x01\x00'
+IQZ_INDEX_MAGIC = b'WFIQZIDX'
+chunkHeaderType = struct.Struct('<II')
+indexEntryType = np.dtype([('offset', '<u8'), ('size', '<u4'), ('samples', '<u4')])
+trailerType = struct.Struct('<QQ8s')
+
+def getDefaultCodec():
+    return 'zstd' if zstandard is not None else 'zlib'
+
+def shuffleBytes(data, itemSize):
+    # Byte planes: all low bytes, then all high bytes. Noise is mostly in the low byte of 16-bit samples,
+    # high bytes are similar and compress well. 8-bit data is not changed.
+    if itemSize == 1:
+        return data
+    return np.ascontiguousarray(np.frombuffer(data, np.uint8).reshape(-1, itemSize).T)
+
+def unshuffleBytes(data, itemSize):
+    if itemSize == 1:
+        return data
+    return np.ascontiguousarray(np.frombuffer(data, np.uint8).reshape(itemSize, -1).T).tobytes()
+
+def compressChunk(data, codec, itemSize, level):
+    data = shuffleBytes(data, itemSize)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return zlib.compress(data, level)
+
+def decompressChunk(data, codec, itemSize):
+    if codec == 'zstd':
+        raw = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raw = zlib.decompress(data)
+    return unshuffleBytes(raw, itemSize)
+
+class CompressedIQWriter(object):
+    """Chunks are compressed by a thread pool (zlib and zstd release the GIL), written in order"""
+
+    def __init__(self, filePath, sampleRate, bps, frequency=0, chunkSamples=256*1024, workers=None, codec=None,
+                 level=None, flushInterval=0, useFsync=False):
+        self.file = open(filePath, "wb")
+        self.codec = codec if codec is not None else getDefaultCodec()
+        if self.codec == 'zstd' and zstandard is None:
+            print("Warning: zstandard is not installed, zlib is used")
+            self.codec = 'zlib'
+        self.level = level if level is not None else (3 if self.codec == 'zstd' else 1)
+        self.itemSize = 1 if bps == 8 else 2
+        self.frameSize = 2*self.itemSize
+        self.chunkSize = chunkSamples*self.frameSize
+        self.buffer = bytearray()
+        self.index = []
+        self.bytesWritten = 0
+        self.rawBytes = 0
+        self.flushInterval = flushInterval
+        self.useFsync = useFsync
+        self.lastFlush = time.monotonic()
+        workers = workers or os.cpu_count() or 1
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.pending = collections.deque()
+        self.maxPending = 2*workers
+
+        meta = { "datatype": "ci8" if bps == 8 else "ci16_le", "sample_rate": sampleRate, "frequency": frequency,
+                 "codec": self.codec, "shuffle": self.itemSize, "chunk_samples": chunkSamples }
+        metaData = json.dumps(meta).encode('utf-8')
+        self.file.write(IQZ_MAGIC)
+        self.file.write(struct.pack('<I', len(metaData)))
+        self.file.write(metaData)
+        self.position = self.file.tell()
+
+    def write(self, data):
+        self.buffer += np.asarray(data).reshape(-1).view(np.uint8).tobytes()
+        while len(self.buffer) >= self.chunkSize:
+            self._submit(bytes(self.buffer[:self.chunkSize]))
+            del self.buffer[:self.chunkSize]
+        self.checkFlush()
+
+    def _submit(self, chunk):
+        self.pending.append((len(chunk), self.pool.submit(compressChunk, chunk, self.codec, self.itemSize, self.level)))
+        # Bounded queue: wait for the oldest chunk if the compression is behind
+        while len(self.pending) > self.maxPending or (len(self.pending) > 0 and self.pending[0][1].done()):
+            self._writeChunk()
+
+    def _writeChunk(self):
+        rawSize, future = self.pending.popleft()
+        compressed = future.result()
+        samples = int(rawSize/self.frameSize)
+        self.file.write(chunkHeaderType.pack(len(compressed), samples))
+        self.file.write(compressed)
+        self.index.append((self.position, len(compressed), samples))
+        self.position += chunkHeaderType.size + len(compressed)
+        self.bytesWritten += chunkHeaderType.size + len(compressed)
+        self.rawBytes += rawSize
+
+    def checkFlush(self):
+        if self.flushInterval <= 0:
+            return
+        now = time.monotonic()
+        if now - self.lastFlush >= self.flushInterval:
+            self.flush()
+            self.lastFlush = now
+
+    def flush(self):
+        # Completed chunks only, the current chunk stays in memory
+        while len(self.pending) > 0:
+            self._writeChunk()
+        self.file.flush()
+        if self.useFsync:
+            os.fsync(self.file.fileno())
+
+    def getCompressionRatio(self):
+        return self.bytesWritten/self.rawBytes if self.rawBytes > 0 else 1.0
+
+    def close(self):
+        if len(self.buffer) > 0:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.flush()
+        self.pool.shutdown()
+        indexOffset = self.file.tell()
+        self.file.write(np.array(self.index, dtype=indexEntryType).tobytes())
+        self.file.write(trailerType.pack(indexOffset, len(self.index), IQZ_INDEX_MAGIC))
+        if self.useFsync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+class CompressedIQReader(object):
+    """Random access to the .iqz chunks, read(size) gives sequential raw data like a file"""
+
+    def __init__(self, filePath):
+        self.file = open(filePath, "rb")
+        if self.file.read(len(IQZ_MAGIC)) != IQZ_MAGIC:
+            raise ValueError('Unknown file format')
+        metaLen = struct.unpack('<I', self.file.read(4))[0]
+        self.meta = json.loads(self.file.read(metaLen).decode('utf-8'))
+        self.dataOffset = self.file.tell()
+        self.sampleRate = int(self.meta["sample_rate"])
+        self.frequency = int(self.meta["frequency"])
+        self.codec = self.meta["codec"]
+        self.itemSize = int(self.meta["shuffle"])
+        self.bitsPerSample = 8*self.itemSize
+        self.frameSize = 2*self.itemSize
+        self.index = self.readIndex()
+        self.chunkStarts = np.concatenate(([0], np.cumsum(self.index['samples'], dtype=np.int64)))
+        self.samplesNum = int(self.chunkStarts[-1])
+        self.readPos = 0
+        self.cachedChunk = (None, None)
+
+    def readIndex(self):
+        self.file.seek(0, 2)
+        fileSize = self.file.tell()
+        if fileSize >= self.dataOffset + trailerType.size:
+            self.file.seek(fileSize - trailerType.size)
+            indexOffset, count, magic = trailerType.unpack(self.file.read(trailerType.size))
+            if magic == IQZ_INDEX_MAGIC:
+                self.file.seek(indexOffset)
+                return np.frombuffer(self.file.read(count*indexEntryType.itemsize), dtype=indexEntryType)
+
+        # No index (interrupted recording): walk the chunk headers
+        index = []
+        pos = self.dataOffset
+        while pos + chunkHeaderType.size <= fileSize:
+            self.file.seek(pos)
+            size, samples = chunkHeaderType.unpack(self.file.read(chunkHeaderType.size))
+            if pos + chunkHeaderType.size + size > fileSize:
+                break
+            index.append((pos, size, samples))
+            pos += chunkHeaderType.size + size
+        return np.array(index, dtype=indexEntryType)
+
+    def readChunk(self, chunkIndex):
+        # Last chunk is kept, sequential small reads decompress each chunk once
+        if self.cachedChunk[0] == chunkIndex:
+            return self.cachedChunk[1]
+        offset, size, samples = self.index[chunkIndex]
+        self.file.seek(int(offset) + chunkHeaderType.size)
+        data = decompressChunk(self.file.read(int(size)), self.codec, self.itemSize)
+        self.cachedChunk = (chunkIndex, data)
+        return data
+
+    def readSamples(self, sampleStart, count):
+        # Raw data of [sampleStart, sampleStart+count), only the needed chunks are decompressed
+        count = max(0, min(count, self.samplesNum - sampleStart))
+        chunk = int(np.searchsorted(self.chunkStarts, sampleStart, side='right')) - 1
+        parts = []
+        pos = sampleStart
+        while count > 0:
+            data = self.readChunk(chunk)
+            start = int(pos - self.chunkStarts[chunk])
+            n = min(count, int(self.index[chunk]['samples']) - start)
+            parts.append(data[start*self.frameSize:(start + n)*self.frameSize])
+            pos += n
+            count -= n
+            chunk += 1
+        return b''.join(parts)
+
+    def seek(self, sampleIndex):
+        self.readPos = sampleIndex
+
+    def read(self, size):
+        data = self.readSamples(self.readPos, int(size/self.frameSize))
+        self.readPos += int(len(data)/self.frameSize)
+        return data
+
+    def close(self):
+        self.file.close()
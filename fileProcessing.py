@@ -1,23 +1,32 @@
 import numpy as np
+import os, io
 import utils
 import optparse
 import time, datetime
 import imageProcessing
+import signalProcessing
 import sys
 import re as regexp
-import wave
-from waveFile import WaveFile
+import json, struct
+import collections
+from waveFile import WaveFile, WAV_SIZE_LIMIT
+from compressedIQ import CompressedIQWriter, CompressedIQReader
+from version import *
 from PIL import Image
 
-def waterfallSaveProcess(imageWidth, imageHeight, sampleRate, frequency, outputFolder, imageFileName, dataPipe):
+def waterfallSaveProcess(imageWidth, imageHeight, sampleRate, frequency, outputFolder, imageFileName, ring):
     try:
         savedCount = 0
         while True:
             timeout = 10
-            if dataPipe.poll(timeout):
-                data = dataPipe.recv()
-                if len(data) == 0:
+            slot = ring.get(timeout)
+            if slot is not None:
+                # Image block: uint8 array (frequency steps, imageHeight, imageWidth, 3), view of the shared memory
+                sequence, timestamp, block = slot
+                if len(block) == 0:
+                    ring.release()
                     break
+                data = block.reshape(-1, imageHeight, imageWidth, 3)
           
                 now = datetime.datetime.now()
                 
@@ -37,6 +46,8 @@ def waterfallSaveProcess(imageWidth, imageHeight, sampleRate, frequency, outputF
                 fileName = "{}-{:05d}.jpg".format(imageFileName, savedCount)
                 filePath = utils.makeFilePath(outputFolder, fileName)
                 img_total.save(filePath)
+                data, block = None, None
+                ring.release()
                 
                 savedCount += 1
             
@@ -50,6 +61,7 @@ def waterfallSaveProcess(imageWidth, imageHeight, sampleRate, frequency, outputF
     except:
         pass
       
+    ring.close()
     print("")
     print("waterfallSaveProcess done")
 
@@ -98,33 +110,464 @@ def combineImages(imageFileName, filesSavedCount, doRemove = True):
         exc_type, exc_obj, tb = sys.exc_info()
         print("combineImages error:", e.args[0], tb.tb_lineno)
 
-def iqSaveProcess(dataFile, dataPipe):
+class IQWriter(object):
+    """Coalesces many small IQ buffers into large aligned writes, flush/fsync by time interval"""
+    alignment = 4096
+
+    def __init__(self, filePath, writeSize=4*1024*1024, flushInterval=0, useFsync=False):
+        self.file = open(filePath, "wb", buffering=0)
+        self.writeSize = max(self.alignment, writeSize - writeSize % self.alignment)
+        self.buffer = np.empty(self.writeSize, dtype=np.uint8)
+        self.bufferLen = 0
+        self.flushInterval = flushInterval
+        self.useFsync = useFsync
+        self.lastFlush = time.monotonic()
+        self.bytesWritten = 0
+        self.preallocated = False
+        # Duration of each file write, seconds
+        self.latencies = []
+
+    def preallocate(self, size):
+        # Reserve the whole file at once (less fragmentation, no metadata updates while writing),
+        # the unused part is truncated on close
+        if size <= 0 or not hasattr(os, 'posix_fallocate'):
+            return False
+        try:
+            os.posix_fallocate(self.file.fileno(), 0, size)
+            self.preallocated = True
+        except OSError as e:
+            print("Warning: file preallocation failed:", str(e))
+        return self.preallocated
+
+    def getLatencyString(self):
+        if len(self.latencies) == 0:
+            return "no writes"
+        p50, p99, p999 = 1000*np.percentile(self.latencies, [50, 99, 99.9])
+        return "{} writes, p50 {:.2f}ms, p99 {:.2f}ms, p99.9 {:.2f}ms, max {:.2f}ms".format(len(self.latencies), p50, p99, p999,
+                                                                                         1000*max(self.latencies))
+
+    def write(self, data):
+        raw = np.asarray(data).reshape(-1).view(np.uint8)
+        pos = 0
+        while pos < len(raw):
+            n = min(len(raw) - pos, self.writeSize - self.bufferLen)
+            self.buffer[self.bufferLen:self.bufferLen + n] = raw[pos:pos + n]
+            self.bufferLen += n
+            pos += n
+            if self.bufferLen == self.writeSize:
+                self._writeBuffer(self.writeSize)
+        self.checkFlush()
+
+    def _writeBuffer(self, size):
+        t_start = time.perf_counter()
+        self.file.write(memoryview(self.buffer)[:size])
+        self.latencies.append(time.perf_counter() - t_start)
+        self.bytesWritten += size
+        # Keep the tail for the next write, so all writes except the last one are aligned
+        tail = self.bufferLen - size
+        if tail > 0:
+            self.buffer[:tail] = self.buffer[size:self.bufferLen]
+        self.bufferLen = tail
+
+    def checkFlush(self):
+        if self.flushInterval <= 0:
+            return
+        now = time.monotonic()
+        if now - self.lastFlush >= self.flushInterval:
+            self.flush()
+            self.lastFlush = now
+
+    def flush(self):
+        aligned = self.bufferLen - self.bufferLen % self.alignment
+        if aligned > 0:
+            self._writeBuffer(aligned)
+        if self.useFsync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.bufferLen > 0:
+            self._writeBuffer(self.bufferLen)
+        if self.preallocated:
+            self.file.truncate(self.file.tell())
+        if self.useFsync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+class WaveIQWriter(IQWriter):
+    """Streams IQ directly to the HDSDR-compatible WAV, header sizes are updated on each flush, every few seconds and on close"""
+    headerInterval = 5
+
+    def __init__(self, filePath, sampleRate, bps, keep8bit=False, writeSize=4*1024*1024, flushInterval=0, useFsync=False,
+                 waveFormat='auto'):
+        IQWriter.__init__(self, filePath, writeSize, flushInterval, useFsync)
+        self.bps = bps
+        self.keep8bit = keep8bit and bps == 8
+        self.wave = WaveFile(sample_rate=sampleRate, samples_num=0, bits_per_sample=8 if self.keep8bit else 16,
+                             wave_format=waveFormat)
+        # Header goes through the staging buffer, so the file writes stay aligned to the file blocks
+        header = io.BytesIO()
+        self.wave.saveHeader(header)
+        self.headerSize = self.wave.data_offset
+        IQWriter.write(self, np.frombuffer(header.getvalue(), dtype=np.uint8))
+        self.frameSize = int(2*self.wave.bits_per_sample/8)
+        self.isFull = False
+        self.lastHeaderPatch = time.monotonic()
+
+    def write(self, data):
+        raw = np.asarray(data).reshape(-1)
+        if self.bps == 8:
+            values = raw.view(np.int8)
+            if self.keep8bit:
+                # 8-bit WAV samples are unsigned
+                raw = values.view(np.uint8) ^ 0x80
+            else:
+                raw = values.astype(np.int16)
+                raw *= 32
+        if self.wave.wave_format == 'wav':
+            # Standard RIFF header: data after 4GB is not saved
+            remaining = int((WAV_SIZE_LIMIT + self.headerSize - self.bytesWritten - self.bufferLen)/self.frameSize)*self.frameSize
+            if raw.nbytes > remaining:
+                if not self.isFull:
+                    print("Warning: WAV file size limit (4GB) reached, IQ data is not saved, use --iqFormat=auto, rf64 or w64")
+                    self.isFull = True
+                raw = raw.view(np.uint8)[:remaining]
+        IQWriter.write(self, raw)
+        # Without --iqFlush the header is still updated, an interrupted file keeps the sizes of the written data
+        if time.monotonic() - self.lastHeaderPatch >= self.headerInterval:
+            self.patchHeader()
+
+    def patchHeader(self):
+        self.lastHeaderPatch = time.monotonic()
+        # Header is still in the staging buffer, it will be written with the first data block
+        if self.bytesWritten < self.headerSize:
+            return
+        self.wave.patchHeader(self.file, int((self.bytesWritten - self.headerSize)/self.frameSize))
+
+    def flush(self):
+        IQWriter.flush(self)
+        self.patchHeader()
+
+    def close(self):
+        if self.bufferLen > 0:
+            self._writeBuffer(self.bufferLen)
+        self.patchHeader()
+        IQWriter.close(self)
+
+class SigMFIQWriter(IQWriter):
+    """SigMF recording: raw ci8/ci16_le samples in .sigmf-data, metadata in .sigmf-meta.
+       A new capture segment is added on each retune or gap, so a time can be found without reading the data.
+       Changed metadata is saved at most every metaInterval seconds, on flush and on close"""
+    metaInterval = 5
+
+    def __init__(self, dataFile, sampleRate, bps, frequency, hardware="", writeSize=4*1024*1024, flushInterval=0, useFsync=False):
+        IQWriter.__init__(self, dataFile + ".sigmf-data", writeSize, flushInterval, useFsync)
+        self.metaPath = dataFile + ".sigmf-meta"
+        self.sampleRate = sampleRate
+        self.frameSize = 2 if bps == 8 else 4
+        self.frequency = frequency
+        self.nextSampleIndex = None
+        self.droppedSamples = 0
+        self.meta = { "global": { "core:datatype": "ci8" if bps == 8 else "ci16_le",
+                                  "core:sample_rate": sampleRate,
+                                  "core:version": "1.0.0",
+                                  "core:recorder": "SDR Waterfall2Img " + getVersion() },
+                      "captures": [],
+                      "annotations": [] }
+        if len(hardware) > 0:
+            self.meta["global"]["core:hw"] = hardware
+        self.metaChanged = False
+        self.writeMeta()
+        # First capture is saved at once, later changes by time
+        self.lastMetaWrite = 0
+
+    def getSamplesCount(self):
+        return int((self.bytesWritten + self.bufferLen)/self.frameSize)
+
+    def addCapture(self, frequency, timestamp):
+        capture = { "core:sample_start": self.getSamplesCount(), "core:frequency": frequency }
+        if timestamp > 0:
+            dt = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+            capture["core:datetime"] = dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        self.meta["captures"].append(capture)
+        self.metaChanged = True
+
+    def write(self, data):
+        IQWriter.write(self, data)
+        # Without --iqFlush the metadata is still saved, an interrupted recording keeps its captures
+        if self.metaChanged and time.monotonic() - self.lastMetaWrite >= self.metaInterval:
+            self.writeMeta()
+
+    def setStreamPosition(self, sampleIndex, frequency, timestamp, samplesNum, isGap=False):
+        # Called before each buffer: stream sample index, tuning and time of its first sample.
+        # isGap: samples were lost before the buffer, but the stream index doesn't show it (driver overflow)
+        if frequency <= 0:
+            frequency = self.frequency
+        if self.nextSampleIndex is None or frequency != self.frequency:
+            self.addCapture(frequency, timestamp)
+        elif sampleIndex >= 0 and sampleIndex != self.nextSampleIndex:
+            # Buffers were dropped: time jumps, sample numbering in the file continues
+            dropped = sampleIndex - self.nextSampleIndex
+            self.droppedSamples += dropped
+            self.addCapture(frequency, timestamp)
+            self.meta["annotations"].append({ "core:sample_start": self.getSamplesCount(),
+                                              "core:comment": "Gap, {} samples dropped".format(dropped) })
+        elif isGap:
+            self.addCapture(frequency, timestamp)
+            self.meta["annotations"].append({ "core:sample_start": self.getSamplesCount(),
+                                              "core:comment": "Gap, unknown length" })
+        self.frequency = frequency
+        self.nextSampleIndex = sampleIndex + samplesNum if sampleIndex >= 0 else None
+
+    def writeMeta(self):
+        # Replaced atomically, the file is valid even if the recording is interrupted
+        tmpPath = self.metaPath + ".tmp"
+        with open(tmpPath, "w") as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(tmpPath, self.metaPath)
+        self.metaChanged = False
+        self.lastMetaWrite = time.monotonic()
+
+    def flush(self):
+        IQWriter.flush(self)
+        self.writeMeta()
+
+    def close(self):
+        IQWriter.close(self)
+        self.writeMeta()
+
+def readSigMFMeta(fileInput):
+    # "name.sigmf-data" or "name.sigmf-meta" => metadata dictionary
+    metaPath = os.path.splitext(fileInput)[0] + ".sigmf-meta"
+    with open(metaPath, "r") as f:
+        return json.load(f)
+
+def saveStreamReport(filePath, report):
+    # Stream counters and gap log (SDR.getStreamReport), saved next to the image or IQ file
     try:
-        savedCount = 0
+        with open(filePath, "w") as f:
+            json.dump(report, f, indent=2)
+    except Exception as e:
+        print("Error: cannot save stream report", filePath, e)
+
+# Waterfall line times: header (magic, sample rate, image width, frequency steps), then one record per line and step
+LINE_TIMES_MAGIC = b'WFLINES1'
+lineTimesHeaderType = struct.Struct('<8sdII')
+lineTimesType = np.dtype([('line', '<u4'), ('step', '<u2'), ('hardware', '<u2'), ('sample', '<u8'), ('time', '<f8')])
+
+class LineTimesWriter(object):
+    """Stream sample index and time of the first sample of each waterfall line"""
+
+    def __init__(self, filePath, sampleRate, imageWidth, frequencySteps=1):
+        self.file = open(filePath, "wb")
+        self.file.write(lineTimesHeaderType.pack(LINE_TIMES_MAGIC, sampleRate, imageWidth, frequencySteps))
+        self.record = np.zeros(1, dtype=lineTimesType)
+
+    def write(self, line, step, sampleIndex, timestamp, isHardware=False):
+        self.record[0] = (line, step, 1 if isHardware else 0, sampleIndex, timestamp)
+        self.file.write(self.record.tobytes())
+
+    def close(self):
+        self.file.close()
+
+def readLineTimes(filePath):
+    # => (sample rate, image width, frequency steps), records array (line, step, hardware, sample, time)
+    with open(filePath, "rb") as f:
+        magic, sampleRate, imageWidth, frequencySteps = lineTimesHeaderType.unpack(f.read(lineTimesHeaderType.size))
+        if magic != LINE_TIMES_MAGIC:
+            raise ValueError('Unknown file format')
+        data = f.read()
+    records = np.frombuffer(data[:len(data) - len(data) % lineTimesType.itemsize], dtype=lineTimesType)
+    return (sampleRate, imageWidth, frequencySteps), records
+
+def getWaveExtension(waveFormat):
+    if waveFormat == 'sigmf':
+        return ".sigmf-data"
+    if waveFormat == 'iqz':
+        return ".iqz"
+    return ".w64" if waveFormat == 'w64' else ".wav"
+
+def getIQFileName(timestamp, frequency):
+    # HDSDR-like name without extension: "HDSDR_20171002_191902Z_7603kHz_RF"
+    dtStr = datetime.datetime.fromtimestamp(timestamp).strftime("%Y%m%d_%H%M%SZ")
+    return "HDSDR_{}_{}kHz_RF".format(dtStr, int(frequency/1000))
+
+def createIQWriter(dataFile, waveFormat, sampleRate, bps, keep8bit=False, frequency=0, hardware="",
+                   writeSize=4*1024*1024, flushInterval=0, useFsync=False):
+    if waveFormat == 'sigmf':
+        return SigMFIQWriter(dataFile, sampleRate, bps, frequency, hardware, writeSize, flushInterval, useFsync)
+    if waveFormat == 'iqz':
+        return CompressedIQWriter(dataFile + ".iqz", sampleRate, bps, frequency, flushInterval=flushInterval, useFsync=useFsync)
+    filePath = dataFile + getWaveExtension(waveFormat)
+    return WaveIQWriter(filePath, sampleRate, bps, keep8bit, writeSize, flushInterval, useFsync, waveFormat)
+
+def writeIQ(writer, data, timestamp, sampleIndex=-1, frequency=0, flags=0):
+    if isinstance(writer, SigMFIQWriter):
+        writer.setStreamPosition(sampleIndex, frequency, timestamp, int(len(data)/writer.frameSize), (flags & IQ_FLAG_GAP) != 0)
+    writer.write(data)
+
+def closeIQWriter(writer):
+    writer.close()
+    if isinstance(writer, CompressedIQWriter):
+        print("IQ compression ratio: {:.2f} ({})".format(writer.getCompressionRatio(), writer.codec))
+    else:
+        print("IQ write latency:", writer.getLatencyString())
+
+# Ring slot flags of the IQ buffers
+IQ_FLAG_TRIGGER = 1
+# Empty slot with this flag closes the current segment (gated recording)
+IQ_FLAG_STOP = 2
+# End of stream, the IQ saving process closes the file and exits
+IQ_FLAG_END = 4
+# Samples were lost before this buffer (driver overflow), SigMF gets a new capture with the buffer time
+IQ_FLAG_GAP = 8
+
+class TriggeredIQWriter(object):
+    """Keeps the last preTrigger seconds of IQ in memory. On trigger a new file is created with this history,
+       data is written until postTrigger seconds after the last triggered buffer.
+       Gated mode: only the gate-open buffers are received, the file is closed by IQ_FLAG_STOP.
+       Each saved segment is added to segmentsLog (CSV): file, start time, start sample, samples, duration"""
+
+    def __init__(self, createWriter, sampleRate, bps, preTrigger=5, postTrigger=5, gated=False, segmentsLog=None):
+        # createWriter: (timestamp, frequency) => IQ writer
+        self.createWriter = createWriter
+        self.gated = gated
+        self.segmentsLog = segmentsLog
+        self.sampleRate = sampleRate
+        self.rawFrameSize = 2 if bps == 8 else 4
+        self.historySamples = int(preTrigger*sampleRate)
+        self.postSamples = int(postTrigger*sampleRate)
+        self.history = collections.deque()
+        self.historyLen = 0
+        self.writer = None
+        self.samplesCount = 0
+        self.stopSample = 0
+        self.eventsCount = 0
+        self.segmentStart = None
+        self.segmentSamples = 0
+        # Samples written to the event files (the rest only passes through the history)
+        self.samplesWritten = 0
+
+    def write(self, data, flags, timestamp, sampleIndex=-1, frequency=0):
+        if flags & IQ_FLAG_STOP:
+            if self.writer is not None:
+                self.stop()
+            return
+        samples = int(len(data)/self.rawFrameSize)
+        if flags & IQ_FLAG_TRIGGER:
+            self.stopSample = self.samplesCount + samples + self.postSamples
+            if self.writer is None:
+                self.start(timestamp, sampleIndex, frequency)
+
+        if self.writer is not None:
+            writeIQ(self.writer, data, timestamp, sampleIndex, frequency, flags)
+            self.segmentSamples += samples
+            self.samplesWritten += samples
+            if not self.gated and self.samplesCount + samples >= self.stopSample:
+                self.stop()
+        else:
+            self.addHistory(data, timestamp, sampleIndex, frequency, samples, flags)
+        self.samplesCount += samples
+
+    def addHistory(self, data, timestamp, sampleIndex, frequency, samples, flags=0):
+        # Ring data is a view of the shared memory, a copy is stored
+        self.history.append((np.array(data), timestamp, sampleIndex, frequency, samples, flags))
+        self.historyLen += samples
+        while len(self.history) > 0 and self.historyLen - self.history[0][4] >= self.historySamples:
+            self.historyLen -= self.history.popleft()[4]
+
+    def start(self, timestamp, sampleIndex, frequency):
+        # Segment starts with the oldest buffer of the history, timestamp is the time of its first sample
+        if len(self.history) > 0:
+            data, t, index, f, samples, dataFlags = self.history[0]
+            timestamp, sampleIndex = t, index
+        if sampleIndex < 0:
+            sampleIndex = self.samplesCount - self.historyLen
+        self.writer = self.createWriter(timestamp, frequency)
+        self.eventsCount += 1
+        self.segmentStart = (timestamp, sampleIndex)
+        self.segmentSamples = 0
+        print("IQ trigger: {} started".format(self.writer.file.name) +
+              (", {:.1f}s before the trigger".format(self.historyLen/self.sampleRate) if self.historySamples > 0 else ""))
+        while len(self.history) > 0:
+            data, t, index, f, samples, dataFlags = self.history.popleft()
+            writeIQ(self.writer, data, t, index, f, dataFlags)
+            self.segmentSamples += samples
+            self.samplesWritten += samples
+        self.historyLen = 0
+
+    def stop(self):
+        print("IQ trigger: {} saved, {:.1f}s".format(self.writer.file.name, self.segmentSamples/self.sampleRate))
+        closeIQWriter(self.writer)
+        if self.segmentsLog is not None:
+            self.logSegment()
+        self.writer = None
+
+    def logSegment(self):
+        timestamp, sampleIndex = self.segmentStart
+        isNew = not os.path.exists(self.segmentsLog)
+        with open(self.segmentsLog, "a") as f:
+            if isNew:
+                f.write("file,start_time,start_sample,samples,duration_s\n")
+            startTime = datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S.%f")
+            f.write("{},{},{},{},{:.3f}\n".format(os.path.basename(self.writer.file.name), startTime, sampleIndex,
+                                                 self.segmentSamples, self.segmentSamples/self.sampleRate))
+
+    def checkFlush(self):
+        if self.writer is not None:
+            self.writer.checkFlush()
+
+    def close(self):
+        if self.writer is not None:
+            self.stop()
+
+def iqSaveProcess(dataFile, ring, sampleRate, bps, keep8bit=False, writeSize=4*1024*1024, flushInterval=0, useFsync=False,
+                  waveFormat='auto', frequency=0, hardware="", preallocateSize=0, triggerMode=False, preTrigger=5, postTrigger=5,
+                  gated=False, triggerStats=None):
+    # Blocks until the data is available, all buffers go directly to "dataFile.wav" (or .w64, .sigmf-data, .iqz).
+    # Trigger mode: only the data around the triggered buffers is saved, one file per event,
+    # segments are listed in "dataFile_segments.csv", samples written and events count are set in triggerStats (shared array)
+    writer = None
+    try:
+        if triggerMode:
+            def createEventWriter(timestamp, eventFrequency):
+                eventFile = getIQFileName(timestamp, eventFrequency or frequency)
+                n = 1
+                while os.path.exists(eventFile + getWaveExtension(waveFormat)):
+                    n += 1
+                    eventFile = "{}_{}".format(getIQFileName(timestamp, eventFrequency or frequency), n)
+                return createIQWriter(eventFile, waveFormat, sampleRate, bps, keep8bit, eventFrequency or frequency, hardware,
+                                      writeSize, flushInterval, useFsync)
+            writer = TriggeredIQWriter(createEventWriter, sampleRate, bps, preTrigger, postTrigger, gated, dataFile + "_segments.csv")
+        else:
+            writer = createIQWriter(dataFile, waveFormat, sampleRate, bps, keep8bit, frequency, hardware, writeSize, flushInterval, useFsync)
+            # Compressed size is not known in advance
+            if preallocateSize > 0 and waveFormat != 'iqz':
+                writer.preallocate(writer.file.tell() + writer.bufferLen + preallocateSize)
         while True:
-            if dataPipe.poll():
-                data = dataPipe.recv()
-                if len(data) == 0:
-                    break
-            
-                #data_ = data #data.astype('int16')
-                #data1 = np.zeros(2*len(data), dtype='int16')
-                #dataR = data.real * 4096
-                #dataI = data.imag * 4096
-                #data2 = np.append(dataR.astype('int16'), dataI.astype('int16'))
-                #for p in range(len(data)):
-                #    data1[2*p]   = dataR[p]
-                #    data1[2*p+1] = dataI[p]
-                #data2 = data.astype('complex64')
-                
-                #print("Save:", len(data), type(data), type(data[0]))
-                
-                fileName = "{}-{:05d}.iq".format(dataFile, savedCount)
-                #dataR.tofile(fileName)
-                #fileName = "{}-{:05d}.q".format(dataFile, savedCount)
-                data.tofile(fileName)
-                
-                savedCount += 1
+            slot = ring.get(timeout=1)
+            if slot is None:
+                # No data: flush on time even if the stream is paused
+                writer.checkFlush()
+                continue
+
+            # Raw IQ buffer, view of the shared memory
+            sequence, timestamp, data = slot
+            sampleIndex, dataFrequency, flags = ring.getSlotInfo()
+            if flags & IQ_FLAG_END:
+                ring.release()
+                break
+            if len(data) == 0 and flags == 0:
+                ring.release()
+                continue
+
+            if triggerMode:
+                writer.write(data, flags, timestamp, sampleIndex, dataFrequency)
+                if triggerStats is not None:
+                    triggerStats[0], triggerStats[1] = writer.samplesWritten, writer.eventsCount
+            else:
+                writeIQ(writer, data, timestamp, sampleIndex, dataFrequency, flags)
+            data = None
+            ring.release()
 
     except Exception as e:
         exc_type, exc_obj, tb = sys.exc_info()
@@ -133,116 +576,114 @@ def iqSaveProcess(dataFile, dataPipe):
         pass
     except:
         pass
-    
+
+    if writer is not None:
+        if triggerMode:
+            writer.close()
+            print("IQ trigger events saved:", writer.eventsCount)
+        else:
+            closeIQWriter(writer)
+    ring.close()
     print("")
     print("iqSaveProcess done")
 
-def combineIQData(fileName, iqSavedCount, sampleRate, bps):
-    fileOutput = "{}.wav".format(fileName)
+def mapIQData(filePath, dataOffset, samplesNum, sampwidth, imageWidth, average):
+    # Data chunk as (lines, average, imageWidth) array of raw IQ pairs (int16 for 8-bit, uint32 for 16-bit).
+    # Memory-mapped: nothing is read until a line block is used, no per-frame reads and copies.
+    rawType = np.int16 if sampwidth == 1 else np.uint32
+    lines = int(samplesNum/(imageWidth*average))
+    if lines == 0:
+        return np.zeros((0, average, imageWidth), dtype=rawType)
+    return np.memmap(filePath, dtype=rawType, mode='r', offset=dataOffset, shape=(lines, average, imageWidth))
 
-    for p in range(iqSavedCount):
-        fileInput = "{}-{:05d}.iq".format(fileName, p)
-
-        try:
-            file = open(fileInput, "rb")
-            if bps == 8:
-                data = np.fromfile(file, dtype=np.int8)
-                fileData = data.astype('int16')
-                fileData *= 32
-            else:
-                fileData = np.fromfile(file, dtype=np.int16)
-                #fileData.byteswap(True)
-                #fileData = fileData.byteswap().newbyteorder()
-                #fileData = data.astype('int16')
-                #print("D", type(fileData[0]), len(fileData))
-                #for d in range(len(fileData)/2):
-                #    v = fileData[2*d]
-                #    fileData[2*d] = fileData[2*d+1]
-                #    fileData[2*d+1] = v
-            file.close()
-    
-            if p % 100 == 0:
-                print("Combine chunks: {} of {}".format(p+1, iqSavedCount))
-
-            if p == 0:
-                # Create new file
-                with open(fileOutput, "wb") as fileNew:
-                    cnt = len(fileData)
-                    w = WaveFile(sample_rate=sampleRate, samples_num=cnt*iqSavedCount)
-                    w.saveHeader(fileNew)
-                    fileNew.write(fileData)
-            else:
-                # Append to the end
-                with open(fileOutput, "ab") as fileAppend:
-                    fileAppend.write(fileData)
-
-            utils.deleteFile(fileInput)
-        except Exception as e:
-            exc_type, exc_obj, tb = sys.exc_info()
-            print("combineIQData error:", str(e), e.args[0], tb.tb_lineno)
-          
-    print("Done")
-
-def waveToSpectrum(fileInput, fileOutput, imageWidth, average):
-    wav = wave.open(fileInput, "r")
-    nchannels = wav.getnchannels()
-    nframes   = wav.getnframes()
-    sampleRate = wav.getframerate()
-    sampwidth = wav.getsampwidth()
+def waveToSpectrum(fileInput, fileOutput, imageWidth, average, windowType='hann', palette='classic', useAutoLevels=False):
     frequency = 100000000
-    
-    # Extract frequency from the filename: HDSDR_20171019_164248Z_100000kHz_RF
-    m = regexp.search('_([0-9]+)kHz', fileInput, regexp.IGNORECASE)
-    if m:
-        found = m.group(1)
-        frequency = 1000*int(found)
+    isSigMF = fileInput.endswith(".sigmf-data") or fileInput.endswith(".sigmf-meta")
+    isCompressed = fileInput.endswith(".iqz")
+    reader = None
+    if isCompressed:
+        # Compressed chunks, reader gives the raw signed samples
+        reader = CompressedIQReader(fileInput)
+        nchannels = 2
+        sampwidth = reader.itemSize
+        sampleRate = reader.sampleRate
+        nframes = reader.samplesNum
+        if reader.frequency > 0:
+            frequency = reader.frequency
+    elif isSigMF:
+        # SigMF: signed samples without header, parameters from the metadata
+        meta = readSigMFMeta(fileInput)
+        dataPath = os.path.splitext(fileInput)[0] + ".sigmf-data"
+        dataOffset = 0
+        nchannels = 2
+        sampwidth = 1 if meta["global"]["core:datatype"] == "ci8" else 2
+        sampleRate = int(meta["global"]["core:sample_rate"])
+        nframes = int(os.path.getsize(dataPath)/(2*sampwidth))
+        if len(meta["captures"]) > 0:
+            frequency = int(meta["captures"][0].get("core:frequency", frequency))
+    else:
+        # WAV, RF64 or Wave64
+        with open(fileInput, "rb") as wav:
+            header = WaveFile.readHeader(wav)
+        dataPath = fileInput
+        dataOffset = header.data_offset
+        nchannels = header.channels_num
+        nframes   = header.samples_num
+        sampleRate = header.sample_rate
+        sampwidth = int(header.bits_per_sample/8)
+
+        # Extract frequency from the filename: HDSDR_20171019_164248Z_100000kHz_RF
+        m = regexp.search('_([0-9]+)kHz', fileInput, regexp.IGNORECASE)
+        if m:
+            found = m.group(1)
+            frequency = 1000*int(found)
     
     print("Channels:", nchannels)
     print("Sample rate:", sampleRate)
     print("Samples:", nframes)
     print("Bytes per sample:", sampwidth)
     print("Central frequency:", frequency)
-    if sampwidth != 2 or nchannels != 2:
-        print("Only 16-bit stereo files are supported in this version")
+    if sampwidth not in [1, 2] or nchannels != 2:
+        print("Only 8/16-bit stereo files are supported in this version")
         return
 
     print("")
     print("Converting...")
 
-    # Get wav data, convert to FFT
-    fftLines = []
-    block_size = imageWidth
-    dataMovingBlock = np.zeros(imageWidth)
-    for p in range(int(nframes/(block_size*nchannels*average))):
-        fftData = np.zeros(imageWidth)
-        for v in range(average):
-            # Read samples
-            frames = wav.readframes(imageWidth)
-            data = np.fromstring(frames, np.int32)
-            if len(data) < imageWidth:
-                break
+    linesNum = int(nframes/(imageWidth*average))
+    if linesNum > 16384:
+        print("Warning: image too big, only the first 16384 lines are used. Use 'average' parameter to reduce the size.")
+        linesNum = 16384
+    if reader is None:
+        frames = mapIQData(dataPath, dataOffset, nframes, sampwidth, imageWidth, average)
 
-            # 2x16bit => I + Q
-            data = data[:imageWidth]
-            dataForFFT = data[0:imageWidth].astype('uint32')
-            re = dataForFFT & 0xFFFF
-            im = dataForFFT >> 16
-            dataC = np.asfarray(re) + 1j*np.asfarray(im)
-            
-            # Get FFT
-            fft = imageProcessing.applyFFT(dataC, imageWidth)
-            fftData += fft
-        
-        fftData /= average
-        fftLine = imageProcessing.generateNewLine(imageWidth, fftData, iqBPS=sampwidth*8)
-        fftLines.append(fftLine)
-        
-        if len(fftLines) % 100 == 0:
-            print("{} lines added".format(len(fftLines)))
+    # Get data, convert to FFT: blocks of lines (about 4M samples), each block in one batched FFT call
+    fftLines = np.zeros((linesNum, imageWidth, 3), dtype=np.uint8)
+    blockLines = max(1, int(4*1024*1024/(imageWidth*average)))
+    spectrum = imageProcessing.SpectrumAverager(imageWidth, average, windowType, dtype=np.complex64)
+    unpacker = signalProcessing.IQUnpacker(blockLines*average*imageWidth)
+    autoLevels = imageProcessing.AutoLevels() if useAutoLevels else None
+    for l in range(0, linesNum, blockLines):
+        count = min(blockLines, linesNum - l)
+        if reader is not None:
+            raw = reader.readSamples(l*average*imageWidth, count*average*imageWidth)
+            data = np.frombuffer(raw, np.int16 if sampwidth == 1 else np.uint32)
+        else:
+            data = frames[l:l + count].reshape(-1)
+            if sampwidth == 1 and not isSigMF:
+                # Unsigned 8-bit => signed pairs in int16, as in the SDR buffer
+                data = data ^ np.int16(-0x7f80)
+
+        # 2x8bit or 2x16bit => I + Q
+        dataC = unpacker.unpack(data)
+        fftBlock = spectrum.getSpectrumLines(dataC.reshape(count, average, imageWidth))
+
+        for p in range(count):
+            fftData = fftBlock[p]
+            levels = autoLevels.update(fftData) if autoLevels is not None else None
+            imageProcessing.generateNewLine(imageWidth, fftData, iqBPS=sampwidth*8, out=fftLines[l + p], palette=palette, levels=levels)
 
-        if len(fftLines) > 16384:
-            print("Warning: image too big, stopped. Use 'average' parameter to reduce the size.")
-            break
+        print("{} lines added".format(l + count))
 
     # Save to image
     img = imageProcessing.createImageHeader(imageWidth, sampleRate, frequency)
@@ -7,6 +7,7 @@ from PIL import Image, ImageDraw, ImageFont
 import random
 import os, sys, time
 import utils
+import signalProcessing
 
 headerH = 20
 
@@ -22,13 +23,22 @@ def getNearestImageWidth(width):
         v *= 2
     return v
 
+def getHeaderStep(sampleRate):
+    # 500KHz labels for wide spans, 1-2-5 steps with at least 2 labels for the narrow (zoomed) ones
+    for power in range(5, -1, -1):
+        for m in [ 5, 2, 1 ]:
+            step = m*10**power
+            if sampleRate/step >= 2:
+                return step
+    return 1
+
 def createImageHeader(imageWidth, sampleRate, frequency):
     try:
         img = Image.new('RGB', (imageWidth, headerH))
         draw = ImageDraw.Draw(img)
         font = ImageFont.load_default() # ImageFont.truetype("sans-serif.ttf", 12)
         
-        step = 500000
+        step = getHeaderStep(sampleRate)
         fft = imageWidth
         tickW = step*fft/sampleRate
         middleX = imageWidth/2
@@ -72,21 +82,259 @@ def imageFromArray(data):
 def imageToArray(img):
     return np.array(img)
 
-def generateNewLine(imageWidth, data, iqBPS):
-    paletteR, paletteG, paletteB = 4, 1, 4
-    k = 2 if iqBPS == 8 else 4*256
-    def convert(val):
-      v = val if val < 255 else 255
-      return [v/paletteR, v/paletteG, v/paletteB]
-
-    # Reverce array parts (high frequency - right part)
-    partsLR = np.split((data/k).astype(int), 2)
-    pts1 = [convert(pt) for pt in partsLR[1]]
-    pts2 = [convert(pt) for pt in partsLR[0]]    
-    return np.array(pts1 + pts2)
-
-def applyFFT(rawData, imageWidth):
-    data = np.hanning(imageWidth)*rawData
-    rawFFt = np.fft.fft(rawData, n = imageWidth, norm="ortho")
+# Palettes: 256-entry uint8 RGB tables, created once
+paletteTypes = [ 'classic', 'viridis', 'inferno', 'gray' ]
+_paletteAnchors = {
+    'viridis': [ (68,1,84), (71,45,123), (59,82,139), (44,114,142), (33,145,140), (40,174,128), (94,201,98), (173,220,48), (253,231,37) ],
+    'inferno': [ (0,0,4), (31,12,72), (85,15,109), (136,34,106), (186,54,85), (227,89,51), (249,142,9), (249,203,53), (252,255,164) ],
+    'gray':    [ (0,0,0), (255,255,255) ],
+}
+_paletteLUTs = {}
+
+def getPaletteLUT(name='classic'):
+    lut = _paletteLUTs.get(name)
+    if lut is not None:
+        return lut
+
+    v = np.arange(256)
+    if name == 'classic':
+        # value/4, value, value/4
+        paletteR, paletteG, paletteB = 4, 1, 4
+        lut = np.stack([v//paletteR, v//paletteG, v//paletteB], axis=1)
+    elif name in _paletteAnchors:
+        # Linear interpolation between the anchor colours
+        anchors = np.array(_paletteAnchors[name], dtype=np.float64)
+        x = np.linspace(0, 255, len(anchors))
+        lut = np.stack([np.interp(v, x, anchors[:, c]) for c in range(3)], axis=1).round()
+    else:
+        raise ValueError('Unknown palette: {}'.format(name))
+
+    lut = lut.astype(np.uint8)
+    lut.flags.writeable = False
+    _paletteLUTs[name] = lut
+    return lut
+
+class AutoLevels(object):
+    """Running noise floor and peak levels: exponential moving average of per-line percentiles"""
+
+    def __init__(self, alpha=0.05, lowPercentile=10, highPercentile=99.5):
+        self.alpha = alpha
+        self.lowPercentile = lowPercentile
+        self.highPercentile = highPercentile
+        self.low = None
+        self.high = None
+
+    def update(self, data):
+        # One partial sort per line instead of the full percentile calculation
+        lastIndex = len(data) - 1
+        lowIndex = int(lastIndex*self.lowPercentile/100)
+        highIndex = int(lastIndex*self.highPercentile/100)
+        part = np.partition(data, (lowIndex, highIndex))
+        low, high = float(part[lowIndex]), float(part[highIndex])
+        if self.low is None:
+            self.low, self.high = low, high
+        else:
+            self.low += self.alpha*(low - self.low)
+            self.high += self.alpha*(high - self.high)
+        return self.getLevels()
+
+    def getLevels(self):
+        if self.low is None:
+            return None
+        return self.low, max(self.high, self.low*1.01 + 1e-9)
+
+def generateNewLine(imageWidth, data, iqBPS, out=None, palette='classic', levels=None):
+    # FFT magnitudes => uint8 RGB row, written to 'out' (imageWidth, 3) if provided
+    # levels: (low, high) magnitudes for the palette range, fixed scaling is used if None
+    if out is None:
+        out = np.empty((imageWidth, 3), dtype=np.uint8)
+
+    if levels is not None:
+        low, high = levels
+        index = np.clip((data - low)*(255/(high - low)), 0, 255).astype(np.intp)
+    else:
+        k = 2 if iqBPS == 8 else 4*256
+        index = np.clip(data/k, 0, 255).astype(np.intp)
+    # Reverce array parts (high frequency - right part), same as fftshift
+    half = imageWidth//2
+    lut = getPaletteLUT(palette)
+    np.take(lut, index[half:], axis=0, out=out[:imageWidth - half])
+    np.take(lut, index[:half], axis=0, out=out[imageWidth - half:])
+    return out
+
+# Window registry: precomputed windows, created once per (size, type, dtype)
+windowTypes = [ 'hann', 'blackmanharris', 'flattop', 'kaiser' ]
+kaiserBeta = 14
+spectrumTypes = [ 'fft', 'pfb' ]
+_windows = {}
+_pfbFilters = {}
+
+def _cosineSumWindow(size, coeffs):
+    # Periodic (DFT-even) window, a0 - a1*cos(x) + a2*cos(2x) - ...
+    x = 2*np.pi*np.arange(size)/size
+    w = np.zeros(size)
+    for k, a in enumerate(coeffs):
+        w += (-1)**k * a * np.cos(k*x)
+    return w
+
+def getWindow(size, windowType='hann', dtype=np.float64):
+    key = (size, windowType, np.dtype(dtype).str)
+    window = _windows.get(key)
+    if window is not None:
+        return window
+
+    if windowType == 'hann':
+        w = _cosineSumWindow(size, [0.5, 0.5])
+    elif windowType == 'blackmanharris':
+        w = _cosineSumWindow(size, [0.35875, 0.48829, 0.14128, 0.01168])
+    elif windowType == 'flattop':
+        w = _cosineSumWindow(size, [0.21557895, 0.41663158, 0.277263158, 0.083578947, 0.006947368])
+    elif windowType == 'kaiser':
+        w = np.kaiser(size + 1, kaiserBeta)[:size]
+    else:
+        raise ValueError('Unknown window type: {}'.format(windowType))
+
+    # Normalize to unit RMS to keep the noise floor level for the palette scaling
+    window = (w/np.sqrt(np.mean(w**2))).astype(dtype)
+    window.flags.writeable = False
+    _windows[key] = window
+    return window
+
+def getPFBFilter(size, taps=4, windowType='hann', dtype=np.float64):
+    # Polyphase filterbank prototype: windowed sinc over taps*size samples, shaped as (taps, size)
+    key = (size, taps, windowType, np.dtype(dtype).str)
+    pfbFilter = _pfbFilters.get(key)
+    if pfbFilter is not None:
+        return pfbFilter
+
+    length = taps*size
+    x = (np.arange(length) - length/2)/size
+    h = np.sinc(x)*getWindow(length, windowType)
+    # Same noise floor as the plain window: sum of h^2 equals size
+    h *= np.sqrt(size/np.sum(h**2))
+    pfbFilter = h.reshape(taps, size).astype(dtype)
+    pfbFilter.flags.writeable = False
+    _pfbFilters[key] = pfbFilter
+    return pfbFilter
+
+def applyFFT(rawData, imageWidth, windowType='hann'):
+    data = getWindow(imageWidth, windowType)*rawData[:imageWidth]
+    rawFFt = signalProcessing.fft(data)
+    rawAbs = np.absolute(rawFFt)
+    return rawAbs
+
+def applyPFB(rawData, imageWidth, taps=4, windowType='hann'):
+    # rawData should contain taps*imageWidth samples
+    pfbFilter = getPFBFilter(imageWidth, taps, windowType)
+    data = (pfbFilter*rawData[:taps*imageWidth].reshape(taps, imageWidth)).sum(axis=0)
+    rawFFt = signalProcessing.fft(data)
     rawAbs = np.absolute(rawFFt)
     return rawAbs
+
+class SpectrumAverager(object):
+    """Collects 'average' frames in one 2D array, gets window+FFT+magnitude+mean in a single batched call"""
+
+    def __init__(self, imageWidth, average, windowType='hann', dtype=np.complex128, spectrumType='fft', taps=4):
+        # dtype=np.complex64 keeps the whole chain in float32/complex64 (half of memory bandwidth)
+        # spectrumType='pfb' uses polyphase filterbank, each frame is taps*imageWidth samples long
+        self.imageWidth = imageWidth
+        self.average = max(1, average)
+        self.dtype = np.dtype(dtype)
+        self.realType = np.float32 if self.dtype == np.complex64 else np.float64
+        self.taps = taps if spectrumType == 'pfb' else 1
+        self.frameSize = self.taps*imageWidth
+        self.frames = np.zeros((self.average, self.frameSize), dtype=self.dtype)
+        signalProcessing.planFFT((self.average, imageWidth), self.dtype)
+        self.magnitudes = np.zeros((self.average, imageWidth), dtype=self.realType)
+        if spectrumType == 'pfb':
+            self.window = getPFBFilter(imageWidth, taps, windowType, self.realType)
+        else:
+            self.window = getWindow(imageWidth, windowType, self.realType)
+        self.count = 0
+        # Welch mode: magnitude sum of all overlapped segments of the full buffers
+        self.segmentsSum = np.zeros(imageWidth, dtype=self.realType)
+        self.segmentsCount = 0
+        self.spectrum = np.zeros(imageWidth, dtype=self.realType)
+        # Decimated stream: the tail shorter than a frame, used with the next buffer
+        self.pending = np.zeros(0, dtype=self.dtype)
+
+    def isFull(self):
+        return self.count >= self.average
+
+    def addFrame(self, dataC):
+        if self.isFull(): return
+        n = min(len(dataC), self.frameSize)
+        row = self.frames[self.count]
+        row[:n] = dataC[:n]
+        if n < self.frameSize:
+            row[n:] = 0
+        self.count += 1
+
+    def _transform(self, frames):
+        # (N, frameSize) frames => (N, imageWidth) complex spectrum
+        if self.taps > 1:
+            # Few taps: multiply-accumulate per tap is faster than a (N, taps, width) temporary array
+            frames = frames.reshape(len(frames), self.taps, self.imageWidth)
+            weighted = frames[:, 0]*self.window[0]
+            for t in range(1, self.taps):
+                weighted += frames[:, t]*self.window[t]
+        else:
+            weighted = frames*self.window
+        return signalProcessing.fft(weighted)
+
+    def addBuffer(self, dataC, overlap=0.5):
+        # Welch-style: split the whole buffer into overlapped segments, FFT them at once
+        if len(dataC) < self.frameSize: return
+        step = max(1, int(self.imageWidth*(1 - overlap)))
+        segments = np.lib.stride_tricks.sliding_window_view(dataC, self.frameSize)[::step]
+        rawFFt = self._transform(segments)
+        self.segmentsSum += np.absolute(rawFFt).sum(axis=0, dtype=self.realType)
+        self.segmentsCount += len(segments)
+
+    def addStream(self, dataC, useWelch=False, overlap=0.5):
+        # Buffers can be shorter than a frame (after decimation), frames are taken from the continuous stream
+        if len(self.pending) > 0:
+            dataC = np.concatenate((self.pending, dataC))
+        if useWelch:
+            step = max(1, int(self.imageWidth*(1 - overlap)))
+            count = (len(dataC) - self.frameSize)//step + 1 if len(dataC) >= self.frameSize else 0
+            if count > 0:
+                self.addBuffer(dataC[:(count - 1)*step + self.frameSize], overlap)
+            used = count*step
+        else:
+            count = len(dataC)//self.frameSize
+            for p in range(count):
+                self.addFrame(dataC[p*self.frameSize:(p + 1)*self.frameSize])
+            used = count*self.frameSize
+        self.pending = np.array(dataC[used:], dtype=self.dtype)
+
+    def resetStream(self):
+        self.pending = np.zeros(0, dtype=self.dtype)
+
+    def getSpectrumLines(self, frames):
+        # (lines, average, frameSize) frames => (lines, imageWidth) averaged magnitudes, all lines in one batch
+        lines = len(frames)
+        rawFFt = self._transform(frames.reshape(-1, self.frameSize))
+        magnitudes = np.absolute(rawFFt).astype(self.realType, copy=False)
+        return magnitudes.reshape(lines, -1, self.imageWidth).mean(axis=1)
+
+    def getSpectrum(self):
+        # Result is written to the preallocated buffer, valid until the next call
+        fftData = self.spectrum
+        total = self.count + self.segmentsCount
+        if total == 0:
+            fftData[:] = 0
+            return fftData
+
+        fftData[:] = self.segmentsSum
+        if self.count > 0:
+            rawFFt = self._transform(self.frames[:self.count])
+            magnitudes = self.magnitudes[:self.count]
+            np.absolute(rawFFt, out=magnitudes, casting='same_kind')
+            fftData += magnitudes.sum(axis=0)
+        fftData /= total
+
+        self.count = 0
+        self.segmentsSum[:] = 0
+        self.segmentsCount = 0
+        return fftData
@@ -0,0 +1,125 @@
+# Universal SDR IQ/waterfall image saver.
+# (c) 2017 Dmitrii (dmitryelj@gmail.com)
+
+import numpy as np
+import os
+import multiprocessing
+from multiprocessing import shared_memory
+
+# Slot metadata, stored in the shared memory in front of the data
+slotMetaType = np.dtype([('sequence', np.int64), ('timestamp', np.float64), ('length', np.int64),
+                         ('sampleIndex', np.int64), ('frequency', np.float64), ('flags', np.int64)])
+
+# Shared counters
+COUNTER_WRITTEN = 0
+COUNTER_READ = 1
+COUNTER_DROPPED = 2
+COUNTER_HIGH_WATER = 3
+COUNTER_WAITS = 4
+COUNTERS_NUM = 5
+
+class SharedRingBuffer(object):
+    """Single producer / single consumer ring of fixed-size slots in multiprocessing.shared_memory.
+       Consumer gets numpy views of the slots, data is not pickled or copied through a pipe"""
+
+    def __init__(self, slotSize, slotsNum=32):
+        self.slotSize = int(slotSize)
+        self.slotsNum = int(slotsNum)
+        size = 8*COUNTERS_NUM + slotMetaType.itemsize*self.slotsNum + self.slotSize*self.slotsNum
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        # Only the creator removes the shared memory (forked children get a copy of this object)
+        self.ownerPid = os.getpid()
+        self.freeSlots = multiprocessing.Semaphore(self.slotsNum)
+        self.filledSlots = multiprocessing.Semaphore(0)
+        self._attach()
+        self.counters[:] = 0
+
+    def _attach(self):
+        buf = self.shm.buf
+        metaStart = 8*COUNTERS_NUM
+        dataStart = metaStart + slotMetaType.itemsize*self.slotsNum
+        self.counters = np.ndarray((COUNTERS_NUM,), dtype=np.int64, buffer=buf)
+        self.meta = np.ndarray((self.slotsNum,), dtype=slotMetaType, buffer=buf, offset=metaStart)
+        self.data = np.ndarray((self.slotsNum, self.slotSize), dtype=np.uint8, buffer=buf, offset=dataStart)
+
+    def __getstate__(self):
+        # Child process attaches to the same shared memory by name
+        return { 'name': self.shm.name, 'slotSize': self.slotSize, 'slotsNum': self.slotsNum,
+                 'freeSlots': self.freeSlots, 'filledSlots': self.filledSlots }
+
+    def __setstate__(self, state):
+        self.slotSize = state['slotSize']
+        self.slotsNum = state['slotsNum']
+        self.freeSlots = state['freeSlots']
+        self.filledSlots = state['filledSlots']
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.ownerPid = None
+        self._attach()
+
+    def put(self, data, timestamp=0.0, block=False, timeout=None, sampleIndex=-1, frequency=0.0, flags=0):
+        # Producer: copy data to the next free slot. If the consumer is behind, the data is dropped (block=False)
+        # or the producer waits (block=True). Empty data is the end of stream marker.
+        # sampleIndex, frequency and flags are optional stream position, tuning and events of the data.
+        if isinstance(data, (bytes, bytearray)):
+            raw = np.frombuffer(data, dtype=np.uint8)
+        else:
+            raw = np.asarray(data).reshape(-1).view(np.uint8)
+        if len(raw) > self.slotSize:
+            raise ValueError('Data size {} is bigger than the slot size {}'.format(len(raw), self.slotSize))
+
+        if not self.freeSlots.acquire(False):
+            if not block:
+                self.counters[COUNTER_DROPPED] += 1
+                return False
+            self.counters[COUNTER_WAITS] += 1
+            if not self.freeSlots.acquire(True, timeout):
+                self.counters[COUNTER_DROPPED] += 1
+                return False
+
+        written = int(self.counters[COUNTER_WRITTEN])
+        index = written % self.slotsNum
+        self.data[index, :len(raw)] = raw
+        self.meta[index] = (written, timestamp, len(raw), sampleIndex, frequency, flags)
+        self.counters[COUNTER_WRITTEN] = written + 1
+        level = written + 1 - int(self.counters[COUNTER_READ])
+        if level > self.counters[COUNTER_HIGH_WATER]:
+            self.counters[COUNTER_HIGH_WATER] = level
+        self.filledSlots.release()
+        return True
+
+    def get(self, timeout=None):
+        # Consumer: wait for the next slot, returns (sequence, timestamp, data view) or None on timeout.
+        # The view is valid until release() is called.
+        if not self.filledSlots.acquire(True, timeout):
+            return None
+        index = int(self.counters[COUNTER_READ]) % self.slotsNum
+        sequence, timestamp, length = self.meta[index][['sequence', 'timestamp', 'length']]
+        return int(sequence), float(timestamp), self.data[index, :length]
+
+    def getSlotInfo(self):
+        # Stream sample index, frequency and flags of the slot returned by get()
+        index = int(self.counters[COUNTER_READ]) % self.slotsNum
+        meta = self.meta[index]
+        return int(meta['sampleIndex']), float(meta['frequency']), int(meta['flags'])
+
+    def release(self):
+        self.counters[COUNTER_READ] += 1
+        self.freeSlots.release()
+
+    def getStatus(self):
+        written, read, dropped, highWater, waits = [int(v) for v in self.counters]
+        return { 'written': written, 'read': read, 'level': written - read, 'slots': self.slotsNum,
+                 'dropped': dropped, 'highWater': highWater, 'waits': waits }
+
+    def getStatusString(self):
+        status = self.getStatus()
+        return "{}/{} slots used, max {}, {} dropped, {} waits".format(status['level'], status['slots'], status['highWater'],
+                                                                     status['dropped'], status['waits'])
+
+    def close(self):
+        self.counters = None
+        self.meta = None
+        self.data = None
+        self.shm.close()
+        if self.ownerPid == os.getpid():
+            self.shm.unlink()
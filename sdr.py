@@ -17,6 +17,8 @@ class SDR(object):
         # For debug/simulation only
         self.fakeName = "fake"
         self.fakeSampleRate = 1000000
+        self.fakeStats = self.getEmptyStats()
+        self.fakeReadInfo = (0, None, 0, 0.0)
 
     def listDevices(self):
         try:
@@ -122,23 +124,88 @@ class SDR(object):
           # by SoapySDR.Device.getStreamMTU(). If getStreamMTU() is not implemented by driver,
           # SoapyDevice.default_buffer_size is used instead
           self.sdr.start_stream(buffer_size=65536)
+        else:
+          self.fakeStats = self.getEmptyStats()
+          self.fakeReadInfo = (0, None, 0, 0.0)
+
+    def getBufferSize(self):
+        if self.sdr is not None and self.sdr.buffer is not None:
+            return len(self.sdr.buffer)
+        return 4096
+
+    def allocateBuffer(self):
+        # Empty buffer of the stream size and format, for readStream(buffer)
+        if self.sdr is not None and self.sdr.buffer is not None:
+            return np.empty_like(self.sdr.buffer)
+        return np.empty(4096, dtype=np.uint32)
 
     def stopStream(self):
         if self.sdr is not None:
             self.sdr.stop_stream()
 
-    def readStream(self):
+    def readStream(self, buffer=None):
+        # Data is read to the device buffer or to the supplied one (see allocateBuffer)
         if self.sdr is not None:
-            res = self.sdr.read_stream()
+            res = self.sdr.read_stream(buffer=buffer)
             dataLen = res.ret
             #print("Data received", len(res))
-            return self.sdr.buffer if res.ret > 0 else [], dataLen
+            if buffer is None:
+                buffer = self.sdr.buffer
+            return buffer if res.ret > 0 else [], dataLen
         else:
-            randData = np.random.rand(4096)
+            randData = np.random.rand(2*4096)
             randData *= 32768
             randData -= 16384
             time.sleep(0.01)
-            return randData.astype('int16'), len(randData)
+            # CS16 format, as getBps() reports: I/Q int16 pairs in uint32
+            data = randData.astype('int16').view('uint32')
+            if buffer is not None:
+                buffer[:len(data)] = data
+                data = buffer
+            # Fake hardware clock from the sample count, in the same units as SoapySDR timeNs
+            self.fakeReadInfo = (self.fakeStats['samples'], self.fakeStats['samples']*1000000000//self.fakeSampleRate, 0, time.time())
+            self.fakeStats['reads'] += 1
+            self.fakeStats['samples'] += 4096
+            return data, 4096
+
+    @staticmethod
+    def getEmptyStats():
+        return {'reads': 0, 'samples': 0, 'overflows': 0, 'timeouts': 0, 'underflows': 0, 'errors': 0, 'gaps_not_logged': 0}
+
+    def getStreamStats(self):
+        # Counters of the current stream: reads, samples, overflows, timeouts, underflows, errors
+        if self.sdr is not None:
+            return self.sdr.stream_stats
+        return self.fakeStats
+
+    def getLastReadInfo(self):
+        # Last readStream(): (stream sample index, hardware time in ns or None, overflows count, wall time)
+        if self.sdr is not None:
+            return self.sdr.last_read_info
+        return self.fakeReadInfo
+
+    def getGapLog(self):
+        # Stream errors: (sample index, error code, wall time)
+        if self.sdr is not None:
+            return self.sdr.gap_log
+        return []
+
+    def getErrorName(self, code):
+        if self.sdr is not None:
+            return SoapyDevice.error_name(code)
+        return str(code)
+
+    def getStreamStatusString(self):
+        stats = self.getStreamStats()
+        return "{} overflows, {} timeouts, {} underflows, {} errors".format(stats['overflows'], stats['timeouts'],
+                                                                           stats['underflows'], stats['errors'])
+
+    def getStreamReport(self):
+        # Counters and the gap log, for the sidecar file
+        report = dict(self.getStreamStats())
+        report['gaps'] = [ { 'sample': sample, 'code': code, 'error': self.getErrorName(code), 'time': t }
+                           for sample, code, t in list(self.getGapLog()) ]
+        return report
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,324 @@
+# Universal SDR IQ/waterfall image saver.
+# (c) 2017 Dmitrii (dmitryelj@gmail.com)
+
+import numpy as np
+import os, time, pickle
+import collections
+import utils
+# scipy.fft (multi-threaded) and pyFFTW are optional, numpy is always available
+try:
+    import scipy.fft as scipyFFT
+except ImportError:
+    scipyFFT = None
+try:
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    pyfftw = None
+
+class IQUnpacker(object):
+    """Converts raw SoapySDR buffer to complex samples without temporary arrays"""
+
+    def __init__(self, bufferSize=65536):
+        self.output = np.empty(bufferSize, dtype=np.complex64)
+
+    def unpack(self, data, count=None):
+        # CS8 is stored as int16 (I - low byte, Q - high byte), CS16 as uint32 (I - low word, Q - high word),
+        # both are interleaved signed pairs, so only a dtype view is needed
+        data = np.asarray(data)
+        count = len(data) if count is None else min(count, len(data))
+        pairType = np.int8 if data.dtype.itemsize == 2 else np.int16
+        pairs = data[:count].view(pairType).reshape(-1, 2)
+
+        if len(self.output) < count:
+            self.output = np.empty(count, dtype=self.output.dtype)
+        out = self.output[:count]
+        out.real[:] = pairs[:, 0]
+        out.imag[:] = pairs[:, 1]
+        return out
+
+# FFT backends
+fftBackendTypes = [ 'auto', 'numpy', 'scipy', 'fftw' ]
+fftWisdomFile = "fftw_wisdom.pickle"
+_fftPlans = collections.OrderedDict()
+# Batch sizes change with Welch segments and short reads, only the recently used plans are kept
+fftPlansLimit = 16
+
+def getFFTPlan(key, factory):
+    # Backend plan objects are expensive to create, keep them for the whole run
+    plan = _fftPlans.get(key)
+    if plan is None:
+        plan = factory()
+        _fftPlans[key] = plan
+        while len(_fftPlans) > fftPlansLimit:
+            _fftPlans.popitem(last=False)
+    else:
+        _fftPlans.move_to_end(key)
+    return plan
+
+class NumpyFFT(object):
+    name = 'numpy'
+
+    def __init__(self, workers=1):
+        self.workers = 1
+
+    def plan(self, shape, dtype):
+        pass
+
+    def fft(self, data):
+        return np.fft.fft(data, axis=-1, norm="ortho")
+
+class ScipyFFT(object):
+    name = 'scipy'
+
+    def __init__(self, workers=1):
+        self.workers = workers
+
+    def plan(self, shape, dtype):
+        pass
+
+    def fft(self, data):
+        return scipyFFT.fft(data, axis=-1, norm="ortho", workers=self.workers)
+
+class FFTWFFT(object):
+    """pyFFTW plans per (shape, dtype), wisdom is saved to disk to skip the planning next time"""
+    name = 'fftw'
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.loadWisdom()
+
+    def wisdomPath(self):
+        return utils.makeFilePath(utils.getAppFolder(), fftWisdomFile)
+
+    def loadWisdom(self):
+        try:
+            with open(self.wisdomPath(), "rb") as f:
+                pyfftw.import_wisdom(pickle.load(f))
+        except Exception:
+            pass
+
+    def saveWisdom(self):
+        try:
+            with open(self.wisdomPath(), "wb") as f:
+                pickle.dump(pyfftw.export_wisdom(), f)
+        except Exception as e:
+            print("saveWisdom error:", str(e))
+
+    def plan(self, shape, dtype, effort='FFTW_MEASURE'):
+        # Shapes known in advance are measured (slow planning, fastest transform)
+        shape, dtype = tuple(shape), np.dtype(dtype)
+        key = ('fftw', shape, dtype.str, self.workers)
+        return getFFTPlan(key, lambda: pyfftw.builders.fft(pyfftw.empty_aligned(shape, dtype=dtype),
+                                                           axis=-1, threads=self.workers, planner_effort=effort))
+
+    def fft(self, data):
+        # Shapes not planned before (Welch, short reads) get a quick FFTW_ESTIMATE plan, no measuring during the recording
+        plan = self.plan(data.shape, data.dtype, 'FFTW_ESTIMATE')
+        # Output array belongs to the plan, it is valid until the next call with the same shape
+        out = plan(data)
+        out *= 1/np.sqrt(data.shape[-1])
+        return out
+
+def getAvailableFFTBackends():
+    backends = [ NumpyFFT ]
+    if scipyFFT is not None: backends.append(ScipyFFT)
+    if pyfftw is not None: backends.append(FFTWFFT)
+    return backends
+
+_fftBackend = NumpyFFT()
+
+def getFFTBackend():
+    return _fftBackend
+
+def setFFTBackend(name, workers=None):
+    global _fftBackend
+    workers = workers or os.cpu_count() or 1
+    for backend in getAvailableFFTBackends():
+        if backend.name == name:
+            _fftBackend = backend(workers)
+            return _fftBackend
+    print("Warning: FFT backend '{}' is not available, numpy is used".format(name))
+    _fftBackend = NumpyFFT()
+    return _fftBackend
+
+def selectFastestFFTBackend(size, batch=64, workers=None, dtype=np.complex128, repeat=5):
+    # Startup self-benchmark: try each installed backend on the real FFT size, keep the fastest
+    global _fftBackend
+    workers = workers or os.cpu_count() or 1
+    data = (np.random.randn(batch, size) + 1j*np.random.randn(batch, size)).astype(dtype)
+    results = {}
+    best, bestTime = None, None
+    for backendType in getAvailableFFTBackends():
+        backend = backendType(workers)
+        backend.plan(data.shape, data.dtype)
+        backend.fft(data)   # warm-up
+        t_start = time.perf_counter()
+        for p in range(repeat):
+            backend.fft(data)
+        t = (time.perf_counter() - t_start)/repeat
+        results[backend.name] = t
+        if bestTime is None or t < bestTime:
+            best, bestTime = backend, t
+    _fftBackend = best
+    return results
+
+def saveFFTWisdom():
+    if isinstance(_fftBackend, FFTWFFT):
+        _fftBackend.saveWisdom()
+
+def planFFT(shape, dtype):
+    # Prepare the backend for the batch shape used in the processing loop
+    _fftBackend.plan(shape, dtype)
+
+def fft(data):
+    return _fftBackend.fft(data)
+
+def packIQ(dataC, iqBPS, scale=1):
+    # Complex samples back to the raw SoapySDR buffer format (CS8 as int16, CS16 as uint32), multiplied by scale
+    if iqBPS == 8:
+        pairType, rawType, limit = np.int8, np.int16, 127
+    else:
+        pairType, rawType, limit = np.int16, np.uint32, 32767
+    pairs = np.empty((len(dataC), 2), dtype=pairType)
+    pairs[:, 0] = np.clip(np.rint(dataC.real*scale), -limit - 1, limit)
+    pairs[:, 1] = np.clip(np.rint(dataC.imag*scale), -limit - 1, limit)
+    return pairs.view(rawType).reshape(-1)
+
+def designLowpass(numTaps, cutoff):
+    # Windowed sinc, cutoff relative to the sample rate (0..0.5), unity gain at DC
+    n = np.arange(numTaps) - (numTaps - 1)/2
+    h = 2*cutoff*np.sinc(2*cutoff*n)*np.blackman(numTaps)
+    return h/np.sum(h)
+
+class DecimatorStage(object):
+    """FIR decimator, only every 'factor' output is calculated, filter state is kept between buffers"""
+
+    def __init__(self, factor, tapsPerPhase=16, dtype=np.complex64):
+        self.factor = factor
+        self.numTaps = factor*tapsPerPhase
+        realType = np.float32 if np.dtype(dtype) == np.complex64 else np.float64
+        # -6 dB at the new Nyquist frequency
+        self.taps = designLowpass(self.numTaps, 0.5/factor)[::-1].astype(realType)
+        self.dtype = dtype
+        self.reset()
+
+    def reset(self):
+        self.history = np.zeros(self.numTaps - 1, dtype=self.dtype)
+
+    def process(self, dataC):
+        data = np.concatenate((self.history, dataC))
+        count = (len(data) - self.numTaps)//self.factor + 1
+        if count <= 0:
+            self.history = data
+            return np.zeros(0, dtype=self.dtype)
+
+        # (count, numTaps) strided view, one row per output sample
+        windows = np.lib.stride_tricks.sliding_window_view(data, self.numTaps)[::self.factor][:count]
+        output = windows @ self.taps
+        self.history = data[count*self.factor:]
+        return output.astype(self.dtype, copy=False)
+
+class Decimator(object):
+    """Streaming multi-stage decimator, large ratios are split to stages not bigger than maxStage"""
+
+    def __init__(self, factor, maxStage=8, dtype=np.complex64):
+        self.factor = factor
+        self.stages = [DecimatorStage(f, dtype=dtype) for f in self.splitFactor(factor, maxStage)]
+
+    @staticmethod
+    def splitFactor(factor, maxStage):
+        # 64 => [8, 8], 100 => [5, 5, 4], 11 => [11]
+        primes = []
+        n, p = factor, 2
+        while n > 1:
+            while n % p == 0:
+                primes.append(p)
+                n //= p
+            p += 1
+        stages = []
+        for p in sorted(primes, reverse=True):
+            for i, s in enumerate(stages):
+                if s*p <= maxStage:
+                    stages[i] *= p
+                    break
+            else:
+                stages.append(p)
+        return stages
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def process(self, dataC):
+        for stage in self.stages:
+            dataC = stage.process(dataC)
+        return dataC
+
+class Mixer(object):
+    """Shifts the signal by -frequency (offset to DC), phase is continuous between buffers"""
+
+    def __init__(self, frequency, sampleRate, dtype=np.complex64):
+        self.step = -2*np.pi*frequency/sampleRate
+        self.phase = 0.0
+        self.dtype = dtype
+        self.phasor = np.zeros(0, dtype=dtype)
+
+    def process(self, dataC):
+        count = len(dataC)
+        if len(self.phasor) != count:
+            self.phasor = np.exp(1j*self.step*np.arange(count)).astype(self.dtype)
+        output = dataC*self.phasor
+        output *= np.exp(1j*self.phase)
+        self.phase = (self.phase + self.step*count) % (2*np.pi)
+        return output
+
+def getBandBins(imageWidth, sampleRate, offsetLow, offsetHigh):
+    # Band offsets from the center frequency, Hz => FFT bin indexes (FFT order, DC is the bin 0)
+    low = int(np.floor(offsetLow*imageWidth/sampleRate))
+    high = int(np.ceil(offsetHigh*imageWidth/sampleRate))
+    low, high = max(low, -imageWidth//2), min(high, imageWidth//2 - 1)
+    return np.arange(low, high + 1) % imageWidth
+
+class LevelTrigger(object):
+    """Fires when the strongest bin of the band (all bins if not set) is above the level, dB of the FFT magnitude"""
+
+    def __init__(self, level, bins=None):
+        self.level = level
+        self.bins = bins
+        self.lastLevel = None
+
+    def update(self, fftData):
+        band = fftData[self.bins] if self.bins is not None else fftData
+        self.lastLevel = 20*np.log10(max(float(np.max(band)), 1e-12))
+        return self.lastLevel > self.level
+
+class NoiseFloorDetector(object):
+    """Energy detector with adaptive noise floor. Band mode: total power of the bins above the floor of this power,
+       bin mode: any bin above its own floor. The floor follows the noise only while there is no signal"""
+
+    def __init__(self, threshold=10, bins=None, perBin=False, alpha=0.02):
+        self.threshold = threshold
+        self.bins = bins
+        self.perBin = perBin
+        self.alpha = alpha
+        self.floor = None
+        self.lastExcess = None
+
+    def update(self, fftData):
+        band = fftData[self.bins] if self.bins is not None else fftData
+        power = np.square(band, dtype=np.float64)
+        if not self.perBin:
+            power = np.array([power.mean()])
+        if self.floor is None:
+            self.floor = power.copy()
+        excess = 10*np.log10(np.maximum(power, 1e-24)/np.maximum(self.floor, 1e-24))
+        self.lastExcess = float(np.max(excess))
+        detected = self.lastExcess > self.threshold
+        # Slow adaptation while the signal is present, otherwise a permanent carrier keeps the gate open forever
+        alpha = self.alpha*0.01 if detected else self.alpha
+        self.floor += alpha*(power - self.floor)
+        return detected
+
+    def getFloorDb(self):
+        return 10*np.log10(max(float(np.mean(self.floor)), 1e-24)) if self.floor is not None else None
@@ -5,6 +5,7 @@ import SoapySDR
 import logging
 import numpy
 import math
+import time
 
 logger = logging.getLogger(__name__)
 logger.propagate = False
@@ -13,6 +14,8 @@ logger.setLevel(logging.DEBUG)
 class SoapyDevice:
     """Simple wrapper for SoapySDR"""
     default_buffer_size = 8192
+    # Max entries in the gap log, later gaps are only counted
+    gap_log_size = 10000
 
     def __init__(self, soapy_args='', sample_rate=0, bandwidth=0, corr=0, gain=None, auto_gain=False,
                  channel=0, antenna='', settings=None, force_sample_rate=False, force_bandwidth=False,
@@ -21,6 +24,9 @@ class SoapyDevice:
         self.buffer = None
         self.buffer_size = buffer_size
         self.buffer_overflow_count = 0
+        self.stream_stats = self._empty_stream_stats()
+        self.gap_log = []
+        self.last_read_info = (0, None, 0, 0.0)
         self.stream = None
         self.stream_args = stream_args
         self.stream_timeout = 0
@@ -389,6 +395,9 @@ class SoapyDevice:
         buf_format = numpy.int16 if self.dataFormat == SoapySDR.SOAPY_SDR_CS8 else numpy.uint32
         self.buffer = numpy.empty(buffer_size, buf_format)
         self.buffer_overflow_count = 0
+        self.stream_stats = self._empty_stream_stats()
+        self.gap_log = []
+        self.last_read_info = (0, None, 0, 0.0)
         self.stream_timeout = stream_timeout or 0.1 + (buffer_size / self.sample_rate)
         logger.debug('SoapySDR stream - buffer size: {}'.format(buffer_size))
         logger.debug('SoapySDR stream - read timeout: {:.6f}'.format(self.stream_timeout))
@@ -405,18 +414,55 @@ class SoapyDevice:
         self.stream = None
         self.buffer = None
 
-    def read_stream(self, stream_timeout=0):
-        """Read samples into buffer"""
+    def read_stream(self, stream_timeout=0, buffer=None):
+        """Read samples into buffer (self.buffer or supplied buffer of the same type)"""
         if not self.is_streaming:
             raise RuntimeError('Streaming is not initialized, you must run start_stream() first!')
 
-        buffer_size = len(self.buffer)
-        res = self.device.readStream(self.stream, [self.buffer], buffer_size,
+        if buffer is None:
+            buffer = self.buffer
+        buffer_size = len(buffer)
+        res = self.device.readStream(self.stream, [buffer], buffer_size,
                                      timeoutUs=math.ceil((stream_timeout or self.stream_timeout) * 1e6))
         #if res.ret > 0 and res.ret < buffer_size:
         #    logger.warning('readStream returned only {} samples, but buffer size is {}!'.format(res.ret, buffer_size))
+        # Stream position of the buffer, hardware time (ns) if the driver has it, overflows so far, wall time
+        read_time = time.time()
+        sample_index = self.stream_stats['samples']
+        self._account_read(res.ret, read_time)
+        has_time = res.ret > 0 and (res.flags & SoapySDR.SOAPY_SDR_HAS_TIME) != 0
+        self.last_read_info = (sample_index, res.timeNs if has_time else None, self.stream_stats['overflows'], read_time)
         return res
 
+    @staticmethod
+    def _empty_stream_stats():
+        return {'reads': 0, 'samples': 0, 'overflows': 0, 'timeouts': 0, 'underflows': 0, 'errors': 0, 'gaps_not_logged': 0}
+
+    def _account_read(self, ret, read_time):
+        """Update stream counters, errors are logged as (sample index, error code, wall time)"""
+        stats = self.stream_stats
+        stats['reads'] += 1
+        if ret >= 0:
+            stats['samples'] += ret
+            return
+
+        if ret == SoapySDR.SOAPY_SDR_OVERFLOW:
+            stats['overflows'] += 1
+        elif ret == SoapySDR.SOAPY_SDR_TIMEOUT:
+            stats['timeouts'] += 1
+        elif ret == SoapySDR.SOAPY_SDR_UNDERFLOW:
+            stats['underflows'] += 1
+        else:
+            stats['errors'] += 1
+        if len(self.gap_log) < self.gap_log_size:
+            self.gap_log.append((stats['samples'], ret, read_time))
+        else:
+            stats['gaps_not_logged'] += 1
+
+    @staticmethod
+    def error_name(code):
+        return SoapySDR.errToStr(code)
+
     def read_stream_into_buffer(self, output_buffer):
         """Read samples into supplied output_buffer (blocks until output_buffer is full)"""
         output_buffer_size = len(output_buffer)
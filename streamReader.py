@@ -0,0 +1,127 @@
+# Universal SDR IQ/waterfall image saver.
+# (c) 2017 Dmitrii (dmitryelj@gmail.com)
+
+import threading
+import queue
+
+class StreamReader(object):
+    """Acquisition thread: reads the SDR stream continuously into a pool of preallocated buffers,
+       filled buffers are passed to the DSP loop through a bounded queue.
+       If the DSP loop is behind and no free buffer is left, the data is read to a spare buffer and dropped,
+       so the driver buffers are never blocked"""
+
+    def __init__(self, sdr, buffersNum=32):
+        self.sdr = sdr
+        self.buffers = [sdr.allocateBuffer() for p in range(buffersNum)]
+        self.spare = sdr.allocateBuffer()
+        self.freeBuffers = queue.Queue()
+        for index in range(buffersNum):
+            self.freeBuffers.put(index)
+        # Filled buffers: (index, dataLen, read info - see SDR.getLastReadInfo)
+        self.filledBuffers = queue.Queue(maxsize=buffersNum)
+        self.current = None
+        self.lastReadInfo = (0, None, 0, 0.0)
+        self.readsCount = 0
+        self.overflowCount = 0
+        self.highWater = 0
+        self.isRunning = False
+        self.thread = None
+
+    def start(self):
+        self.isRunning = True
+        self.thread = threading.Thread(target=self.run, name="StreamReader", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.isRunning:
+            try:
+                index = self.freeBuffers.get_nowait()
+            except queue.Empty:
+                # DSP is behind: keep reading the driver, data is lost
+                self.sdr.readStream(self.spare)
+                self.overflowCount += 1
+                continue
+
+            data, dataLen = self.sdr.readStream(self.buffers[index])
+            if dataLen <= 0:
+                self.freeBuffers.put(index)
+                continue
+            self.readsCount += 1
+            self.filledBuffers.put((index, dataLen, self.sdr.getLastReadInfo()))
+            level = self.filledBuffers.qsize()
+            if level > self.highWater:
+                self.highWater = level
+
+    def readStream(self, timeout=1):
+        # Same result as SDR.readStream(), the buffer is valid until the next call
+        self.releaseCurrent()
+        try:
+            index, dataLen, self.lastReadInfo = self.filledBuffers.get(timeout=timeout)
+        except queue.Empty:
+            return [], 0
+        self.current = index
+        return self.buffers[index], dataLen
+
+    def getLastReadInfo(self):
+        # Same as SDR.getLastReadInfo(), for the buffer returned by readStream()
+        return self.lastReadInfo
+
+    def releaseCurrent(self):
+        if self.current is not None:
+            self.freeBuffers.put(self.current)
+            self.current = None
+
+    def flush(self):
+        # Drop all buffers read before, used after the retune
+        self.releaseCurrent()
+        while True:
+            try:
+                index, dataLen, readInfo = self.filledBuffers.get_nowait()
+            except queue.Empty:
+                break
+            self.freeBuffers.put(index)
+
+    def getStatusString(self):
+        return "{}/{} buffers used, max {}, {} overflows".format(self.filledBuffers.qsize(), len(self.buffers), self.highWater,
+                                                                 self.overflowCount)
+
+    def stop(self):
+        self.isRunning = False
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+            self.thread = None
+        self.flush()
+
+class SampleClock(object):
+    """Time of the stream buffers: from the hardware time if the driver provides it,
+       otherwise from the sample counter anchored at the stream start.
+       Driver overflows lose an unknown number of samples, the counter is anchored again after them"""
+
+    def __init__(self, sampleRate):
+        self.sampleRate = sampleRate
+        self.anchor = None
+        self.hardwareOffset = None
+        self.nextTimeNs = None
+        self.overflowsCount = None
+        self.isHardware = False
+        # Samples were lost before the last buffer: driver overflow or a jump of the hardware time
+        self.isGap = False
+
+    def getTime(self, readInfo, dataLen):
+        # Unix time of the first sample of the buffer, readInfo from SDR.getLastReadInfo()
+        sampleIndex, timeNs, overflowsCount, readTime = readInfo
+        self.isGap = self.overflowsCount is not None and overflowsCount != self.overflowsCount
+        self.overflowsCount = overflowsCount
+        if timeNs is not None:
+            # Hardware clock has its own epoch, the offset to the system time is taken once
+            if self.hardwareOffset is None:
+                self.hardwareOffset = readTime - dataLen/self.sampleRate - timeNs*1e-9
+            elif abs(timeNs - self.nextTimeNs) > 0.5e9*dataLen/self.sampleRate:
+                self.isGap = True
+            self.nextTimeNs = timeNs + 1e9*dataLen/self.sampleRate
+            self.isHardware = True
+            return timeNs*1e-9 + self.hardwareOffset
+        if self.anchor is None or self.isGap:
+            self.anchor = (sampleIndex, readTime - dataLen/self.sampleRate)
+        self.isHardware = False
+        return self.anchor[1] + (sampleIndex - self.anchor[0])/self.sampleRate
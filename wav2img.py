@@ -6,7 +6,7 @@ import optparse
 import utils
 import imageProcessing
 import fileProcessing
-import sys
+import sys, os
 from version import *
 
 if __name__ == '__main__':
@@ -17,22 +17,36 @@ if __name__ == '__main__':
     parser.add_option("--output", dest="fileOutput", help="Image file name", default="")
     parser.add_option("--imagewidth", dest="imagewidth", help="image width", default=1024)
     parser.add_option("--average", dest="average", help="FFT average", default=1)
+    parser.add_option("--palette", dest="palette", help="palette: classic, viridis, inferno, gray", default="classic")
+    parser.add_option("--autoLevels", dest="autoLevels", help="adjust palette range to the noise floor and peaks", default="false")
+    parser.add_option("--window", dest="window", help="FFT window: hann, blackmanharris, flattop, kaiser", default="hann")
     options, args = parser.parse_args()
 
     fileInput = options.fileInput
     if len(fileInput) == 0:
-        print("Run 'python3 wav2img.py --input=file.wav [--output=file.jpg] [--imagewidth=1024] [--average=1]'")
+        print("Run 'python3 wav2img.py --input=file.wav|file.sigmf-data|file.iqz [--output=file.jpg] [--imagewidth=1024] [--average=1] [--window=hann] [--palette=viridis] [--autoLevels=1]'")
         sys.exit(0)
     
-    fileOutput = options.fileOutput if len(options.fileOutput) > 0 else fileInput.replace(".wav", ".jpg")
+    fileOutput = options.fileOutput if len(options.fileOutput) > 0 else os.path.splitext(fileInput)[0] + ".jpg"
     imageWidth = int(options.imagewidth)
     average    = int(options.average)
+    windowType = options.window
+    palette = options.palette
+    useAutoLevels = options.autoLevels == 'true' or options.autoLevels == '1' or options.autoLevels == 'True'
+    if palette not in imageProcessing.paletteTypes:
+        print("Error: unknown palette '{}', use one of {}".format(palette, imageProcessing.paletteTypes))
+        sys.exit(1)
+    if windowType not in imageProcessing.windowTypes:
+        print("Error: unknown window '{}', use one of {}".format(windowType, imageProcessing.windowTypes))
+        sys.exit(1)
     
     print("Convert {} to {}".format(fileInput, fileOutput))
     print("Image width:", imageWidth)
     print("Average:", average)
+    print("FFT window:", windowType)
+    print("Palette:", palette, "(auto levels)" if useAutoLevels else "")
     
-    fileProcessing.waveToSpectrum(fileInput, fileOutput, imageWidth, average)
+    fileProcessing.waveToSpectrum(fileInput, fileOutput, imageWidth, average, windowType, palette, useAutoLevels)
 
     print("Done")
     print("")
@@ -1,8 +1,21 @@
 import struct
 
+# Sony Wave64 chunk GUIDs
+W64_RIFF = b'riff\x2e\x91\xcf\x11\xa5\xd6\x28\xdb\x04\xc1\x00\x00'
+W64_WAVE = b'wave\xf3\xac\xd3\x11\x8c\xd1\x00\xc0\x4f\x8e\xdb\x8a'
+W64_FMT  = b'fmt \xf3\xac\xd3\x11\x8c\xd1\x00\xc0\x4f\x8e\xdb\x8a'
+W64_DATA = b'data\xf3\xac\xd3\x11\x8c\xd1\x00\xc0\x4f\x8e\xdb\x8a'
+
+# Max data size for the 32-bit RIFF header
+WAV_SIZE_LIMIT = 0xFFFFFFFF - 1024
+
 class WaveFile(object):
 
-    def __init__(self, sample_rate, samples_num, bits_per_sample=16):
+    def __init__(self, sample_rate, samples_num, bits_per_sample=16, wave_format='wav'):
+        # wave_format: 'wav' - standard RIFF header (up to 4GB)
+        #              'auto' - RIFF header with space reserved for ds64, converted to RF64 if data becomes bigger than 4GB
+        #              'rf64' - EBU RF64 with 64-bit sizes in ds64 chunk
+        #              'w64' - Sony Wave64
         self.subchunk_size = 16		# subchunk data size (16 for PCM)
         self.compression_type = 1	# compression (PCM = 1 [linear quantization])
         self.channels_num = 2		# channels (mono = 1, stereo = 2)
@@ -12,19 +25,68 @@ class WaveFile(object):
         self.samples_num = int(samples_num)
         self.byte_rate = int(self.sample_rate * self.channels_num * self.bits_per_sample / 8)
         self.duration = int(samples_num/self.sample_rate)
+        self.wave_format = wave_format
+        self.data_offset = 0
         self.data = []
 
+    @staticmethod
+    def getFormatForSize(data_size, wave_format='auto'):
+        # Projected data size => header format
+        if wave_format == 'auto' and data_size > WAV_SIZE_LIMIT:
+            return 'rf64'
+        return wave_format
+
     def add_data_subchunk(self, duration, data):
         self.duration += duration
         self.data += data
 
+    def getHeaderSize(self):
+        if self.wave_format == 'w64':
+            return 104
+        if self.wave_format in ['auto', 'rf64']:
+            return 80
+        return 44
+
+    def _fmtChunk(self):
+        return struct.pack('<hhiihh', self.compression_type, self.channels_num, self.sample_rate,
+                           self.byte_rate, self.block_alignment, self.bits_per_sample)
+
+    def _ds64Chunk(self, chunk_id):
+        riff_size = 4 + (8 + 28) + (8 + self.subchunk_size) + (8 + self.subchunk2_size)
+        return chunk_id + struct.pack('<IQQQI', 28, riff_size, self.subchunk2_size, self.samples_num, 0)
+
     def saveHeader(self, f):
         self.subchunk2_size = int(self.samples_num * self.channels_num * self.bits_per_sample / 8)
-        
-        # write RIFF header
-        f.write('RIFF'.encode('utf-8'))
-        f.write(struct.pack('<i', 4 + (8 + self.subchunk_size) + (8 + self.subchunk2_size)))
-        f.write('WAVE'.encode('utf-8'))
+        self.data_offset = self.getHeaderSize()
+
+        if self.wave_format == 'w64':
+            # Sony Wave64: GUID chunk ids, 64-bit chunk sizes (including the chunk header)
+            f.write(W64_RIFF)
+            f.write(struct.pack('<Q', self.data_offset + self.subchunk2_size))
+            f.write(W64_WAVE)
+            f.write(W64_FMT)
+            f.write(struct.pack('<Q', 24 + self.subchunk_size))
+            f.write(self._fmtChunk())
+            f.write(W64_DATA)
+            f.write(struct.pack('<Q', 24 + self.subchunk2_size))
+            return
+
+        if self.wave_format == 'rf64':
+            f.write('RF64'.encode('utf-8'))
+            f.write(struct.pack('<I', 0xFFFFFFFF))
+            f.write('WAVE'.encode('utf-8'))
+            f.write(self._ds64Chunk('ds64'.encode('utf-8')))
+        else:
+            # write RIFF header
+            extra_size = 36 if self.wave_format == 'auto' else 0
+            f.write('RIFF'.encode('utf-8'))
+            f.write(struct.pack('<I', 4 + extra_size + (8 + self.subchunk_size) + (8 + self.subchunk2_size)))
+            f.write('WAVE'.encode('utf-8'))
+            if self.wave_format == 'auto':
+                # Place for ds64 chunk, ignored by the readers
+                f.write('JUNK'.encode('utf-8'))
+                f.write(struct.pack('<I', 28))
+                f.write(bytes(28))
         # write fmt subchunk
         f.write('fmt '.encode('utf-8'))										# chunk type
         f.write(struct.pack('<i', self.subchunk_size))		# data size
@@ -36,8 +98,92 @@ class WaveFile(object):
         f.write(struct.pack('<h', self.bits_per_sample))	# sample depth
         # write data subchunk
         f.write('data'.encode('utf-8'))
-        f.write(struct.pack ('<i', self.subchunk2_size))
+        f.write(struct.pack('<I', 0xFFFFFFFF if self.wave_format == 'rf64' else self.subchunk2_size))
         for d in self.data:
             sound_data = struct.pack('<h', d)
             f.write(sound_data)
 
+    def patchHeader(self, f, samples_num):
+        # Update sizes of the header written before, file position is restored.
+        # 'auto' header becomes RF64 when the data does not fit to 4GB.
+        self.samples_num = int(samples_num)
+        self.subchunk2_size = int(self.samples_num * self.channels_num * self.bits_per_sample / 8)
+        if self.wave_format == 'auto' and self.subchunk2_size > WAV_SIZE_LIMIT:
+            self.wave_format = 'rf64'
+        pos = f.tell()
+        if self.wave_format == 'w64':
+            f.seek(16)
+            f.write(struct.pack('<Q', self.data_offset + self.subchunk2_size))
+            f.seek(self.data_offset - 8)
+            f.write(struct.pack('<Q', 24 + self.subchunk2_size))
+        elif self.wave_format == 'rf64':
+            f.seek(0)
+            f.write('RF64'.encode('utf-8'))
+            f.write(struct.pack('<I', 0xFFFFFFFF))
+            f.seek(12)
+            f.write(self._ds64Chunk('ds64'.encode('utf-8')))
+            f.seek(self.data_offset - 4)
+            f.write(struct.pack('<I', 0xFFFFFFFF))
+        else:
+            # 32-bit sizes can't describe more data: the header is limited, the writer stops at WAV_SIZE_LIMIT
+            data_size = min(self.subchunk2_size, WAV_SIZE_LIMIT)
+            extra_size = 36 if self.wave_format == 'auto' else 0
+            f.seek(4)
+            f.write(struct.pack('<I', 4 + extra_size + (8 + self.subchunk_size) + (8 + data_size)))
+            f.seek(self.data_offset - 4)
+            f.write(struct.pack('<I', data_size))
+        f.seek(pos)
+
+    @staticmethod
+    def readHeader(f):
+        # Parse WAV, RF64 or Wave64 header, returns WaveFile with data_offset and samples_num set
+        riff = f.read(16)
+        if riff[:4] in [b'RIFF', b'RF64'] and riff[8:12] == b'WAVE':
+            wave_format = 'rf64' if riff[:4] == b'RF64' else 'wav'
+            chunk_pos, header_len, align = 12, 8, 2
+        elif riff == W64_RIFF:
+            wave_format = 'w64'
+            chunk_pos, header_len, align = 40, 24, 8
+        else:
+            raise ValueError('Unknown file format')
+
+        fmt, ds64_data_size, data_size = None, None, None
+        while True:
+            f.seek(chunk_pos)
+            header = f.read(header_len)
+            if len(header) < header_len:
+                break
+            if wave_format == 'w64':
+                chunk_id = header[:4] if header[4:16] == W64_FMT[4:] else header[:16]
+                chunk_size = struct.unpack('<Q', header[16:])[0] - 24
+            else:
+                chunk_id = header[:4]
+                chunk_size = struct.unpack('<I', header[4:])[0]
+
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack('<hhiihh', f.read(16))
+            elif chunk_id == b'ds64':
+                riff_size, ds64_data_size = struct.unpack('<QQ', f.read(16))
+            elif chunk_id == b'data':
+                data_size = ds64_data_size if chunk_size == 0xFFFFFFFF and ds64_data_size is not None else chunk_size
+                data_offset = chunk_pos + header_len
+                break
+            chunk_pos += header_len + chunk_size + (-chunk_size % align)
+
+        if fmt is None or data_size is None:
+            raise ValueError('fmt or data chunk not found')
+
+        compression_type, channels_num, sample_rate, byte_rate, block_alignment, bits_per_sample = fmt
+        w = WaveFile(sample_rate, 0, bits_per_sample, wave_format)
+        w.channels_num = channels_num
+        w.block_alignment = block_alignment
+        w.data_offset = data_offset
+        # Interrupted recording: header sizes can be bigger than the real data,
+        # or 0 if the header was never patched - then all data up to the end of the file is used
+        f.seek(0, 2)
+        if data_size == 0:
+            data_size = f.tell() - data_offset
+        data_size = min(data_size, f.tell() - data_offset)
+        w.subchunk2_size = data_size
+        w.samples_num = int(data_size/block_alignment)
+        return w
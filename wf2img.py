@@ -13,21 +13,33 @@ import math
 import optparse
 import datetime
 import imageProcessing
+import signalProcessing
 import fileProcessing
 import utils
 import logging
+import signal
 from sdr import SDR
+from ringBuffer import SharedRingBuffer
+from streamReader import StreamReader, SampleClock
+from waveFile import WaveFile
 from version import *
 if utils.isRaspberryPi():
     import libTFT
 
 def printIntro():
     print(utils.bold('SDR Waterfall2Img, version %s\n' % getVersion()))
-    print(utils.bold('Usage: python3 wf2img.py  --f=frequency [--fStart=f1 --fEnd=f2] [--sr=sampleRate] [--sdr=receiver] [--imagewidth=imageWidth] [--imagefile=fileName] [--average=N] [--saveIQ=1] [--tStart=18:30] [--tLimit=120] [--batch="frequency;timeStart;timeEnd"]'))
+    print(utils.bold('Usage: python3 wf2img.py  --f=frequency [--fStart=f1 --fEnd=f2] [--sr=sampleRate] [--sdr=receiver] [--imagewidth=imageWidth] [--imagefile=fileName] [--average=N] [--window=hann] [--spectrum=pfb --pfbTaps=4] [--welch=1 --overlap=50] [--precision=32] [--fft=auto] [--fftThreads=4] [--zoomOffset=Hz --zoomSpan=Hz] [--palette=viridis] [--autoLevels=1] [--saveIQ=1 --iqFormat=auto|sigmf|iqz] [--iqTrigger=level --iqTriggerLevel=dB --iqPreTrigger=5 --iqPostTrigger=5] [--iqTrigger=gate --iqGateThreshold=10 --iqGateHold=2] [--tStart=18:30] [--tLimit=120] [--batch="frequency;timeStart;timeEnd"]'))
     print("Run 'nohup <python3 wf2img.py parameters> &' to execute in the background")
     print("To combine files, saved before, use: python3 fileProcessing.py --file=fileName.jpg [--delete=true]")
     print("")
 
+# External IQ trigger: 'kill -USR1 <pid>'
+externalTriggers = 0
+
+def onExternalTrigger(signum, frame):
+    global externalTriggers
+    externalTriggers += 1
+
 if __name__ == '__main__':
     printIntro()
     
@@ -46,13 +58,40 @@ if __name__ == '__main__':
     parser.add_option("--fEnd", dest="frequency_end", help="center frequency", default=0)
     parser.add_option("--imagewidth", dest="imagewidth", help="image width", default=1024)
     parser.add_option("--average", dest="average", help="stream average", default=16)
+    parser.add_option("--window", dest="window", help="FFT window: hann, blackmanharris, flattop, kaiser", default="hann")
+    parser.add_option("--spectrum", dest="spectrum", help="spectrum estimator: fft or pfb (polyphase filterbank)", default="fft")
+    parser.add_option("--pfbTaps", dest="pfbTaps", help="polyphase filterbank taps", default=4)
+    parser.add_option("--welch", dest="welch", help="average all overlapped segments of each buffer", default="false")
+    parser.add_option("--overlap", dest="overlap", help="Welch segments overlap in percent", default=50)
+    parser.add_option("--precision", dest="precision", help="DSP precision, 32 (float32) or 64 (float64) bits", default=64)
+    parser.add_option("--fft", dest="fft", help="FFT backend: auto, numpy, scipy, fftw", default="auto")
+    parser.add_option("--fftThreads", dest="fftThreads", help="FFT backend threads (0 - all cores)", default=0)
+    parser.add_option("--palette", dest="palette", help="palette: classic, viridis, inferno, gray", default="classic")
+    parser.add_option("--autoLevels", dest="autoLevels", help="adjust palette range to the noise floor and peaks", default="false")
     parser.add_option("--markerS", dest="markerInS", help="time marker in seconds", default=60)
     parser.add_option("--saveIQ", dest="saveIQ", help="save IQ in HDSDR-compatible wav file", default="false")
+    parser.add_option("--iq8bit", dest="iq8bit", help="keep native 8-bit samples in the IQ file (rtlsdr, hackrf)", default="false")
+    parser.add_option("--iqFlush", dest="iqFlush", help="IQ file flush interval in seconds (0 - on close only)", default=0)
+    parser.add_option("--iqFsync", dest="iqFsync", help="IQ file fsync on flush", default="false")
+    parser.add_option("--iqPrealloc", dest="iqPrealloc", help="preallocate the IQ file for --tLimit/--tEnd duration", default="true")
+    parser.add_option("--iqFormat", dest="iqFormat", help="IQ file format: auto, wav, rf64, w64, sigmf, iqz (auto - RF64 if bigger than 4GB, iqz - compressed)", default="auto")
+    parser.add_option("--iqTrigger", dest="iqTrigger", help="save IQ only around events: off, level (FFT level or SIGUSR1), external (SIGUSR1), gate (energy over noise floor)", default="off")
+    parser.add_option("--iqTriggerLevel", dest="iqTriggerLevel", help="trigger level, dB of the FFT magnitude", default=60)
+    parser.add_option("--iqTriggerBand", dest="iqTriggerBand", help="trigger band, offsets from the center frequency 'f1:f2' in Hz", default="")
+    parser.add_option("--iqGateThreshold", dest="iqGateThreshold", help="gate: power over the noise floor, dB", default=10)
+    parser.add_option("--iqGateHold", dest="iqGateHold", help="gate: seconds without signal before the segment is closed", default=2)
+    parser.add_option("--iqGateDetector", dest="iqGateDetector", help="gate: band (total power of the band) or bin (any FFT bin)", default="band")
+    parser.add_option("--iqPreTrigger", dest="iqPreTrigger", help="seconds saved before the trigger", default=5)
+    parser.add_option("--iqPostTrigger", dest="iqPostTrigger", help="seconds saved after the trigger", default=5)
     parser.add_option("--saveWaterfall", dest="saveWaterfall", help="save waterfall", default="true")
     parser.add_option("--tStart", dest="timeStart", help="app start recording time", default="")
     parser.add_option("--tEnd",   dest="timeEnd",   help="app end recording time", default="")
     parser.add_option("--tLimit", dest="timeLimit", help="app run time limit in seconds", default=9999999)
-    parser.add_option("--decimation", dest="decimation", help="signal decimation", default=1)
+    parser.add_option("--decimation", dest="decimation", help="signal decimation (low-pass filtered)", default=1)
+    parser.add_option("--zoomOffset", dest="zoomOffset", help="zoom mode: offset from the center frequency", default=0)
+    parser.add_option("--zoomSpan", dest="zoomSpan", help="zoom mode: waterfall span", default=0)
+    parser.add_option("--readerThread", dest="readerThread", help="read the SDR stream in a separate thread", default="true")
+    parser.add_option("--readerBuffers", dest="readerBuffers", help="stream reader buffers", default=32)
     parser.add_option("--batch", dest="batch", help="batch job (in format frequency1;time1-1;time1-2;frequency2;time2-1;time2-2)", default="")
     parser.add_option("--debug", dest="debug", help="debug simulation", default="")
     options, args = parser.parse_args()
@@ -63,11 +102,47 @@ if __name__ == '__main__':
     imageWidth = imageProcessing.getNearestImageWidth(int(options.imagewidth))
     average = int(options.average)
     decimation = int(options.decimation)
+    palette = options.palette
+    useAutoLevels = isinstance(options.autoLevels, str) and (options.autoLevels == 'true' or options.autoLevels == '1' or options.autoLevels == 'True')
+    zoomOffset = int(options.zoomOffset)
+    zoomSpan = int(options.zoomSpan)
+    windowType = options.window
+    spectrumType = options.spectrum
+    pfbTaps = max(1, int(options.pfbTaps))
+    useWelch = isinstance(options.welch, str) and (options.welch == 'true' or options.welch == '1' or options.welch == 'True')
+    overlap = min(max(int(options.overlap), 0), 90)/100
+    precision = 32 if int(options.precision) == 32 else 64
+    fftBackend = options.fft
+    fftThreads = int(options.fftThreads)
     markerInS = int(options.markerInS)
     markerRGB = [220,0,0]
     imageHeightLimit = 16384    # Not used yet
     saveWaterfall = isinstance(options.saveWaterfall, str) and (options.saveWaterfall == 'true' or options.saveWaterfall == '1' or options.saveWaterfall == 'True')
     saveIQ = isinstance(options.saveIQ, str) and (options.saveIQ == 'true' or options.saveIQ == '1' or options.saveIQ == 'True')
+    iqFlushInterval = float(options.iqFlush)
+    iqKeep8bit = isinstance(options.iq8bit, str) and (options.iq8bit == 'true' or options.iq8bit == '1' or options.iq8bit == 'True')
+    iqFsync = isinstance(options.iqFsync, str) and (options.iqFsync == 'true' or options.iqFsync == '1' or options.iqFsync == 'True')
+    iqPreallocate = isinstance(options.iqPrealloc, str) and (options.iqPrealloc == 'true' or options.iqPrealloc == '1' or options.iqPrealloc == 'True')
+    iqFormat = options.iqFormat
+    iqTriggerMode = options.iqTrigger
+    iqTriggerLevel = float(options.iqTriggerLevel)
+    iqPreTrigger = float(options.iqPreTrigger)
+    iqPostTrigger = float(options.iqPostTrigger)
+    iqGateThreshold = float(options.iqGateThreshold)
+    iqGateHold = float(options.iqGateHold)
+    if iqTriggerMode not in ['off', 'level', 'external', 'gate']:
+        print("Error: unknown IQ trigger", iqTriggerMode)
+        sys.exit(1)
+    if iqTriggerMode != 'off' and not saveIQ:
+        print("Error: --iqTrigger requires --saveIQ=1")
+        sys.exit(1)
+    if iqTriggerMode != 'off' and hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, onExternalTrigger)
+    if iqFormat not in ['auto', 'wav', 'rf64', 'w64', 'sigmf', 'iqz']:
+        print("Error: unknown IQ file format", iqFormat)
+        sys.exit(1)
+    useReaderThread = isinstance(options.readerThread, str) and (options.readerThread == 'true' or options.readerThread == '1' or options.readerThread == 'True')
+    readerBuffers = max(2, int(options.readerBuffers))
     useDebug = isinstance(options.debug, str) and (options.debug == 'true' or options.debug == '1' or options.debug == 'True')
     outputFolder = utils.getAppFolder()
     frequencies = [ int(options.frequency) ]
@@ -127,6 +202,27 @@ if __name__ == '__main__':
     if device is None and useDebug is False:
         print("Error: no receiver detected")
         sys.exit(1)
+    if windowType not in imageProcessing.windowTypes:
+        print("Error: unknown window '{}', use one of {}".format(windowType, imageProcessing.windowTypes))
+        sys.exit(1)
+    if spectrumType not in imageProcessing.spectrumTypes:
+        print("Error: unknown spectrum '{}', use one of {}".format(spectrumType, imageProcessing.spectrumTypes))
+        sys.exit(1)
+    if palette not in imageProcessing.paletteTypes:
+        print("Error: unknown palette '{}', use one of {}".format(palette, imageProcessing.paletteTypes))
+        sys.exit(1)
+    if fftBackend not in signalProcessing.fftBackendTypes:
+        print("Error: unknown FFT backend '{}', use one of {}".format(fftBackend, signalProcessing.fftBackendTypes))
+        sys.exit(1)
+    if zoomSpan > 0:
+        if decimation > 1 or frequency_steps > 1:
+            print("Error: zoom mode cannot be used with decimation or frequency span")
+            sys.exit(1)
+        # Zoom: offset frequency is mixed to DC, then decimated to the zoom span
+        decimation = max(1, int(round(sampleRate/zoomSpan)))
+        if abs(zoomOffset) + sampleRate/decimation/2 > sampleRate/2:
+            print("Error: zoom band is outside of the receiver band")
+            sys.exit(1)
     if saveIQ is False and saveWaterfall is False:
         print("Error: no task selected, saveIQ and saveWaterfall are both false")
         sys.exit(1)
@@ -143,6 +239,14 @@ if __name__ == '__main__':
         if device == 'rtlsdr':
             sdr.setGainFromString("TUNER:30")
 
+    if fftBackend == 'auto':
+        results = signalProcessing.selectFastestFFTBackend(imageWidth, average, fftThreads,
+                                                           np.complex64 if precision == 32 else np.complex128)
+        for name, t in results.items():
+            print("FFT backend {}: {:.2f}ms".format(name, 1000*t))
+    else:
+        signalProcessing.setFFTBackend(fftBackend, fftThreads)
+
     print("Receiver:", device)
     print("Sample rate:", sampleRate)
     if frequency_steps > 1:
@@ -156,17 +260,48 @@ if __name__ == '__main__':
     print("BPS:", sdr.getBps())
     print("Gains:", sdr.getGains())
     print("Average, blocks:", average)
+    print("FFT window:", windowType)
+    print("Spectrum:", spectrumType if spectrumType != 'pfb' else "pfb, {} taps".format(pfbTaps))
+    print("DSP precision, bits:", precision)
+    print("FFT backend:", signalProcessing.getFFTBackend().name, "threads:", signalProcessing.getFFTBackend().workers)
+    print("Palette:", palette, "(auto levels)" if useAutoLevels else "")
+    print("Zoom:", "offset {}Hz, span {}Hz".format(zoomOffset, int(sampleRate/decimation)) if zoomSpan > 0 else "disabled")
+    print("Welch averaging:", "overlap {}%".format(int(100*overlap)) if useWelch else "disabled")
     print("Vertical markers (s):", markerInS)
     print("Output folder:", outputFolder)
     print("Save waterfall:", saveWaterfall)
-    print("Save IQ:", saveIQ)
+    print("Save IQ:", saveIQ, "(8-bit)" if saveIQ and iqKeep8bit and sdr.getBps() == 8 and decimation == 1 and zoomSpan == 0 else "")
+
+    # IQ trigger: FFT level or energy over the noise floor in the band (optional), SIGUSR1 always works in trigger mode
+    iqDetector = None
+    bins = None
+    if len(options.iqTriggerBand) > 0:
+        f1, f2 = [float(f) for f in options.iqTriggerBand.split(":")]
+        bins = signalProcessing.getBandBins(imageWidth, sampleRate/decimation, min(f1, f2), max(f1, f2))
+    if iqTriggerMode == 'level':
+        iqDetector = signalProcessing.LevelTrigger(iqTriggerLevel, bins)
+    if iqTriggerMode == 'gate':
+        iqDetector = signalProcessing.NoiseFloorDetector(iqGateThreshold, bins, perBin=options.iqGateDetector == 'bin')
+    # FFT is needed for the waterfall or for the detector
+    useSpectrum = saveWaterfall or iqDetector is not None
+    if iqTriggerMode == 'gate':
+        print("IQ gate: {}dB over the noise floor ({}), hold {}s".format(iqGateThreshold, options.iqGateDetector, iqGateHold),
+              "band {}Hz".format(options.iqTriggerBand) if len(options.iqTriggerBand) > 0 else "",
+              "'kill -USR1 {}' to open".format(os.getpid()))
+    elif iqTriggerMode != 'off':
+        print("IQ trigger:", "level {}dB".format(iqTriggerLevel) if iqDetector is not None else "external",
+              "band {}Hz".format(options.iqTriggerBand) if len(options.iqTriggerBand) > 0 else "",
+              "pre {}s, post {}s, 'kill -USR1 {}' to trigger".format(iqPreTrigger, iqPostTrigger, os.getpid()))
     print("")
 
     for index, frequency in enumerate(frequencies):
         # Initialize SDR device
         sdr.setCenterFrequency(frequency)
         sdr.startStream()
+        reader = None
         
+        # Center of the saved band (differs in zoom mode)
+        frequencyOut = frequency + zoomOffset if zoomSpan > 0 else frequency
         timeStart = timesStart[index] if index < len(timesStart) else None
         timeEnd = timesEnd[index] if index < len(timesEnd) else None
         timeLimit = timesLimit[index] if index < len(timesLimit) else 9999999
@@ -176,6 +311,8 @@ if __name__ == '__main__':
         print("Start time:", "-" if timeStart is None else timeStart)
         print("End time:", "-" if timeEnd is None else timeEnd)
         print("Limit in seconds:", "-" if timeLimit == 9999999 else timeLimit)
+        if useWelch:
+            print("Line duration, s: {:.3f}".format(average*sdr.getBufferSize()/sampleRate))
         print("")
 
         # Wait for the start
@@ -195,34 +332,93 @@ if __name__ == '__main__':
 
         # Output name from current time
         dtStr = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-        imageFileName = "{}-{}".format(dtStr, frequency)
+        imageFileName = "{}-{}".format(dtStr, frequencyOut)
         if frequency_steps > 1:
             imageFileName = "{}-{}-{}".format(dtStr, frequency_start, frequency_end)
         # Wav file name, like "HDSDR_20171002_191902Z_7603kHz_RF.wav"
         if saveIQ:
             dtStr = datetime.datetime.now().strftime("%Y%m%d_%H%M%SZ")
-            wavFileName = "HDSDR_{}_{}kHz_RF".format(dtStr, int(frequency/1000))
+            wavFileName = "HDSDR_{}_{}kHz_RF".format(dtStr, int(frequencyOut/1000))
 
         # Image data
         imgBlockSize = 32
         imgBlockNumber = 0
         imgBlockCombine = 2
+        imgRingSlots = 4
+        iqRingSlots = 64
+        iqWriteSize = 4*1024*1024
         filesSavedCount = 0
         iqSavedCount = 0
         iqSavedSize = 0
+        # Stream position of the IQ data (dropped buffers included) and its frequency, for SigMF captures
+        iqSampleIndex = 0
+        # Driver stream position expected for the next buffer: buffers dropped by the acquisition thread are a gap in the IQ stream
+        iqNextStreamIndex = None
+        # Samples lost in the driver (not visible in the stream index): the next IQ buffer gets IQ_FLAG_GAP
+        iqGapFlag = 0
+        iqFrequency = frequencyOut
+        # Trigger flag for the IQ buffers, set from the previous line
+        iqFlags = 0
+        iqExternalTriggers = externalTriggers
+        # Gate: buffers of the current line wait for the detector, only gate-open lines are sent to the IQ process
+        iqGateLine = []
+        iqGateOpen = False
+        iqGateUntil = 0
+        iqStatusTime = time.monotonic()
         iqBPS = sdr.getBps()
+        # Decimated or shifted IQ is saved as CS16: 8-bit samples would lose the processing gain of the filter.
+        # 8-bit values are scaled like in the 16-bit WAV (x32)
+        iqPackScale = 1
+        if decimation > 1 or (zoomSpan > 0 and zoomOffset != 0):
+            iqPackScale = 32 if iqBPS == 8 else 1
+            iqBPS = 16
+        iqFileBPS = 8 if iqBPS == 8 and iqKeep8bit else 16
+        if iqFormat == 'sigmf' or iqFormat == 'iqz':
+            # SigMF and compressed files keep the native sample format
+            iqFileBPS = iqBPS
+        # Expected IQ file size (0 - unknown, no time limit), the header format is selected from it (RF64 for >4GB)
+        iqDuration = timeLimit if timeLimit != 9999999 else 0
+        if timeEnd is not None:
+            iqDuration = (timeEnd - datetime.datetime.now()).total_seconds() if iqDuration == 0 else \
+                         min(iqDuration, (timeEnd - datetime.datetime.now()).total_seconds())
+        iqProjectedSize = int(max(0, iqDuration)*sampleRate/decimation)*2*iqFileBPS//8
+        # Preallocated file size: the recording stops anyway when less than 64MB is free
+        iqPreallocateSize = 0
+        if iqPreallocate and iqProjectedSize > 0:
+            free, total = utils.getDiskSpace()
+            iqPreallocateSize = min(iqProjectedSize, max(0, free - 128*1024*1024))
         
-        # Start saving waterfall process
-        parentPipe, childPipe = multiprocessing.Pipe()
-        params = [ imageWidth, imgBlockSize, int(sampleRate/decimation), frequency, outputFolder, imageFileName, parentPipe ]
+        # Start saving waterfall process, image blocks are passed through the shared memory
+        imgRing = SharedRingBuffer(frequency_steps*imgBlockSize*imageWidth*3, imgRingSlots)
+        params = [ imageWidth, imgBlockSize, int(sampleRate/decimation), frequencyOut, outputFolder, imageFileName, imgRing ]
         process = multiprocessing.Process(target=fileProcessing.waterfallSaveProcess, args=params)
         process.start()
         
-        # Start saving file process
-        iqParentPipe, iqChildPipe = multiprocessing.Pipe()
-        paramsIQ = [ wavFileName, iqParentPipe ]
-        processIQ = multiprocessing.Process(target=fileProcessing.iqSaveProcess, args=paramsIQ)
-        processIQ.start()
+        # Start saving file process (optional), raw IQ buffers are passed through the shared memory
+        iqRing, processIQ = None, None
+        # Trigger modes: samples written and events count, from the IQ process (most of the sent data is not saved)
+        iqTriggerStats = multiprocessing.Array('q', 2) if iqTriggerMode != 'off' else None
+        if saveIQ:
+            iqRing = SharedRingBuffer(sdr.getBufferSize()*4, iqRingSlots)
+            paramsIQ = [ wavFileName, iqRing, int(sampleRate/decimation), iqBPS, iqKeep8bit, iqWriteSize, iqFlushInterval, iqFsync,
+                         WaveFile.getFormatForSize(iqProjectedSize, iqFormat), frequencyOut, sdr.name, iqPreallocateSize,
+                         iqTriggerMode != 'off', iqPreTrigger if iqTriggerMode != 'gate' else 0, iqPostTrigger,
+                         iqTriggerMode == 'gate', iqTriggerStats ]
+            processIQ = multiprocessing.Process(target=fileProcessing.iqSaveProcess, args=paramsIQ)
+            processIQ.start()
+
+        # Acquisition thread (optional): the driver is read while the DSP loop is busy
+        if useReaderThread:
+            reader = StreamReader(sdr, readerBuffers)
+            reader.start()
+        stream = reader if reader is not None else sdr
+        lastStreamStatus = sdr.getStreamStatusString()
+        # Buffer and line times from the stream position (or the hardware time), not from the processing time
+        clock = SampleClock(sampleRate)
+        lineTimes = None
+        if saveWaterfall:
+            lineTimes = fileProcessing.LineTimesWriter(utils.makeFilePath(outputFolder, imageFileName + "-lines.bin"),
+                                                       sampleRate, imageWidth, frequency_steps)
 
         start = datetime.datetime.now()
         timeInS = 24*60*start.hour + 60*start.minute + start.second
@@ -233,8 +429,16 @@ if __name__ == '__main__':
         class FreeSpaceError(Exception): pass
 
         try:
-            # Array of lines for each frequency step
-            samplesToAdd = [[] for i in range(frequency_steps)]
+            spectrum = imageProcessing.SpectrumAverager(imageWidth, average, windowType,
+                                                        dtype=np.complex64 if precision == 32 else np.complex128,
+                                                        spectrumType=spectrumType, taps=pfbTaps)
+            unpacker = signalProcessing.IQUnpacker(sdr.getBufferSize())
+            decimator = signalProcessing.Decimator(decimation) if decimation > 1 else None
+            autoLevels = imageProcessing.AutoLevels() if useAutoLevels else None
+            mixer = signalProcessing.Mixer(zoomOffset, sampleRate) if zoomSpan > 0 and zoomOffset != 0 else None
+            # Image block for all frequency steps: RGB lines, reused for each block
+            imgBlock = np.zeros((frequency_steps, imgBlockSize, imageWidth, 3), dtype=np.uint8)
+            imgBlockLines = 0
             while True:
                 for freq_index in range(frequency_steps):
                     # Set span frequency (optional)
@@ -242,47 +446,77 @@ if __name__ == '__main__':
                         cur_freq = frequency_start + freq_index*frequency_step + frequency_step/2
                         # print("Freq:", cur_freq)
                         sdr.setCenterFrequency(cur_freq)
+                        iqFrequency = cur_freq
                         # Skip first data (needs time to set proper frequency)
-                        sdr.readStream() 
-                        sdr.readStream()
+                        if reader is not None:
+                            reader.flush()
+                        stream.readStream()
+                        stream.readStream()
+                        # Filter state belongs to the previous frequency
+                        if decimator is not None:
+                            decimator.reset()
+                            spectrum.resetStream()
                 
-                    fftData = np.zeros(imageWidth)
                     # Get data
+                    lineTime, lineSample = None, 0
                     for p in range(average):
-                        data, dataLen = sdr.readStream()
+                        data, dataLen = stream.readStream()
                         if dataLen > 0:
-                            # Decimation (optional)
-                            if decimation > 1:
-                                data = data[::decimation]   # data = data.reshape(-1, decimation).mean(axis=1)
-                                dataLen = int(dataLen/decimation)
+                            readInfo = stream.getLastReadInfo()
+                            bufferTime = clock.getTime(readInfo, dataLen)
+                            if clock.isGap:
+                                iqGapFlag = fileProcessing.IQ_FLAG_GAP
+                            if lineTime is None:
+                                lineTime, lineSample = bufferTime, readInfo[0]
+                            if iqNextStreamIndex is None:
+                                iqSampleIndex = readInfo[0] // decimation
+                            elif readInfo[0] > iqNextStreamIndex:
+                                iqSampleIndex += (readInfo[0] - iqNextStreamIndex) // decimation
+                            iqNextStreamIndex = readInfo[0] + dataLen
+                            dataC = None
+                            # Zoom and decimation (optional): shift, low-pass filter, then raw format again for the IQ file
+                            if decimator is not None or mixer is not None:
+                                dataC = unpacker.unpack(data, dataLen)
+                                if mixer is not None:
+                                    dataC = mixer.process(dataC)
+                                if decimator is not None:
+                                    dataC = decimator.process(dataC)
+                                dataLen = len(dataC)
+                                # Short read: the decimator can return no samples yet
+                                if dataLen == 0:
+                                    continue
+                                if saveIQ:
+                                    data = signalProcessing.packIQ(dataC, iqBPS, iqPackScale)
                             # Save IQ
-                            if saveIQ:
-                                iqChildPipe.send(data[0:dataLen])
-                                iqSavedCount += 1
-                                iqSavedSize += dataLen*2*iqBPS/8 # I+Q data in array
+                            if saveIQ and iqTriggerMode == 'gate':
+                                iqGateLine.append((np.array(data[0:dataLen]), bufferTime, iqSampleIndex, iqFrequency, iqGapFlag))
+                                iqGapFlag = 0
+                                iqSampleIndex += dataLen
+                            elif saveIQ:
+                                # Dropped (and counted in the ring status) if the writer is behind
+                                if iqRing.put(data[0:dataLen], bufferTime, sampleIndex=iqSampleIndex, frequency=iqFrequency, flags=iqFlags | iqGapFlag):
+                                    iqGapFlag = 0
+                                    iqSavedCount += 1
+                                    iqSavedSize += dataLen*2*iqFileBPS/8 # I+Q data in the file
+                                iqSampleIndex += dataLen
                             # Save FFT
-                            if saveWaterfall:
-                                dataC = None
-                                if iqBPS == 8:
-                                    # 2x8bit => I + Q
-                                    dataForFFT = data[0:imageWidth].astype('uint16')
-                                    re = dataForFFT & 0xFF
-                                    im = dataForFFT >> 8
-                                    dataC =  np.asfarray(re) + 1j*np.asfarray(im)
+                            if useSpectrum and dataC is not None:
+                                # Decimated buffers can be shorter than a frame
+                                spectrum.addStream(dataC, useWelch, overlap)
+                            elif useSpectrum:
+                                # Welch mode uses the whole buffer, otherwise only one frame
+                                fftLen = dataLen if useWelch else spectrum.frameSize
+                                # 2x8bit or 2x16bit => I + Q
+                                dataC = unpacker.unpack(data, fftLen)
+                                if useWelch:
+                                    spectrum.addBuffer(dataC, overlap)
                                 else:
-                                    # 2x16bit => I + Q
-                                    dataForFFT = data[0:imageWidth].astype('uint32')
-                                    re = dataForFFT & 0xFFFF
-                                    im = dataForFFT >> 16
-                                    dataC = np.asfarray(re) + 1j*np.asfarray(im)
-
-                                fft = imageProcessing.applyFFT(dataC, imageWidth)
-                                # Suppress DC
-                                fft[0] = fft[1]
-                                fftData += fft
+                                    spectrum.addFrame(dataC)
 
-                                #print("FFT", len(fft))
-                    fftData /= average
+                    # FFT of all collected frames at once
+                    fftData = spectrum.getSpectrum()
+                    # Suppress DC
+                    fftData[0] = fftData[1]
 
                     now = datetime.datetime.now()
                     # Check run time
@@ -296,28 +530,76 @@ if __name__ == '__main__':
                     if free < 64*1024*1024:
                         raise FreeSpaceError
 
+                    # IQ gate: line data is sent only if the gate is open, closing is sent as an empty flagged buffer
+                    if iqTriggerMode == 'gate':
+                        nowMono = time.monotonic()
+                        triggered = iqDetector.update(fftData)
+                        if externalTriggers != iqExternalTriggers:
+                            iqExternalTriggers = externalTriggers
+                            triggered = True
+                        if triggered:
+                            iqGateUntil = nowMono + iqGateHold
+                        gateOpen = nowMono < iqGateUntil
+                        if gateOpen:
+                            for gateData, gateTime, gateIndex, gateFrequency, gateFlags in iqGateLine:
+                                if iqRing.put(gateData, gateTime, sampleIndex=gateIndex, frequency=gateFrequency, flags=fileProcessing.IQ_FLAG_TRIGGER | gateFlags):
+                                    iqSavedCount += 1
+                                    iqSavedSize += len(gateData)*2*iqFileBPS/8
+                        elif iqGateOpen:
+                            iqRing.put(b'', time.time(), block=True, timeout=10, flags=fileProcessing.IQ_FLAG_STOP)
+                        iqGateOpen = gateOpen
+                        iqGateLine = []
+                    # IQ trigger: flag is sent with the next buffers, the writer keeps the data before it
+                    elif iqTriggerMode != 'off':
+                        triggered = iqDetector is not None and iqDetector.update(fftData)
+                        if externalTriggers != iqExternalTriggers:
+                            iqExternalTriggers = externalTriggers
+                            triggered = True
+                        iqFlags = fileProcessing.IQ_FLAG_TRIGGER if triggered else 0
+
                     if saveWaterfall:
-                        imgLine = imageProcessing.generateNewLine(imageWidth, fftData, iqBPS)
+                        if lineTime is not None:
+                            lineTimes.write(filesSavedCount*imgBlockSize + imgBlockLines, freq_index, lineSample, lineTime, clock.isHardware)
+                        levels = autoLevels.update(fftData) if autoLevels is not None else None
+                        imgLine = imageProcessing.generateNewLine(imageWidth, fftData, sdr.getBps(), out=imgBlock[freq_index, imgBlockLines],
+                                                                  palette=palette, levels=levels)
                         # Add time marker
-                        diffInS = (now - timeMarker).total_seconds()
+                        lineDateTime = datetime.datetime.fromtimestamp(lineTime) if lineTime is not None else now
+                        diffInS = (lineDateTime - timeMarker).total_seconds()
                         if diffInS > markerInS:
-                            for x in range(10):
-                              imgLine[x] = markerRGB
-                            timeMarker = now
+                            imgLine[:10] = markerRGB
+                            timeMarker = lineDateTime
                         # print("Line added", freq_index)
-                        samplesToAdd[freq_index].append(imgLine)
-        
-                # print("Block added", len(samplesToAdd[0]))
-                # Save data, if ready
-                if len(samplesToAdd[0]) == imgBlockSize:
-                    childPipe.send(samplesToAdd)
+
+                if saveWaterfall:
+                    imgBlockLines += 1
+                # Save data, if ready: one contiguous buffer, no pickling
+                if imgBlockLines == imgBlockSize:
+                    imgRing.put(imgBlock, time.time(), block=True)
                     
-                    samplesToAdd = [[] for i in range(frequency_steps)]
+                    imgBlockLines = 0
                     filesSavedCount += 1
 
-                # Notify if IQ save active
-                if saveIQ and iqSavedCount % 64 == 0:
-                    print("{}:{:02d}s: {}.wav: {}Mb saved, {}Mb free on device".format(int(runTime/60), runTime%60, imageFileName, int(iqSavedSize/(1024*1024)), int(free/(1024*1024))))
+                # Notify if IQ save active (gate: by time, the counter does not change while the gate is closed)
+                iqStatusDue = iqSavedCount % 64 == 0 if iqTriggerMode != 'gate' else time.monotonic() - iqStatusTime > 5
+                if saveIQ and iqStatusDue:
+                    iqStatusTime = time.monotonic()
+                    detectorStr = ""
+                    if iqTriggerMode == 'gate' and iqDetector.lastExcess is not None:
+                        detectorStr = ", gate {}, {:+.1f}dB over the floor {:.1f}dB".format("open" if iqGateOpen else "closed", iqDetector.lastExcess, iqDetector.getFloorDb())
+                    elif iqDetector is not None and iqDetector.lastLevel is not None:
+                        detectorStr = ", trigger level {:.1f}dB".format(iqDetector.lastLevel)
+                    readerStr = ", stream: {}".format(reader.getStatusString()) if reader is not None else ""
+                    savedStr = "{}Mb saved".format(int(iqSavedSize/(1024*1024)))
+                    if iqTriggerStats is not None:
+                        savedStr = "{}Mb saved in {} events, {}Mb sent".format(int(iqTriggerStats[0]*2*iqFileBPS/8/(1024*1024)), iqTriggerStats[1], int(iqSavedSize/(1024*1024)))
+                    print("{}:{:02d}s: {}.wav: {}, {}Mb free on device, buffer: {}".format(int(runTime/60), runTime%60, imageFileName, savedStr, int(free/(1024*1024)), iqRing.getStatusString()) + readerStr + ", driver: " + sdr.getStreamStatusString() + detectorStr)
+                elif not saveIQ:
+                    # Waterfall only: driver errors are shown when they change
+                    streamStatus = sdr.getStreamStatusString()
+                    if streamStatus != lastStreamStatus:
+                        lastStreamStatus = streamStatus
+                        print("{}:{:02d}s: driver: {}".format(int(runTime/60), runTime%60, streamStatus))
 
         except KeyboardInterrupt:
             pass
@@ -332,18 +614,40 @@ if __name__ == '__main__':
             pass
 
         # Stop receiving
+        if reader is not None:
+            reader.stop()
         sdr.stopStream()
+        if lineTimes is not None:
+            lineTimes.close()
+
+        # Stream counters and gaps, next to the image and the IQ file
+        streamReport = sdr.getStreamReport()
+        streamReport.update({ "receiver": sdr.name, "sample_rate": sampleRate, "frequency": frequencyOut,
+                              "start": start.isoformat(), "end": datetime.datetime.now().isoformat(),
+                              "time_source": "hardware" if clock.isHardware else "sample counter" })
+        if reader is not None:
+            streamReport["reader"] = { "buffers": len(reader.buffers), "max_used": reader.highWater, "overflows": reader.overflowCount }
+        if saveWaterfall:
+            fileProcessing.saveStreamReport(utils.makeFilePath(outputFolder, imageFileName + "-stream.json"), streamReport)
+        if saveIQ:
+            fileProcessing.saveStreamReport(wavFileName + "_stream.json", streamReport)
 
-        childPipe.send([])
+        imgRing.put(b'', block=True, timeout=10)
         process.join(timeout=10)
 
-        iqChildPipe.send([])
-        processIQ.join(timeout=10)
+        if processIQ is not None:
+            iqRing.put(b'', block=True, timeout=10, flags=fileProcessing.IQ_FLAG_END)
+            processIQ.join(timeout=10)
 
-        childPipe.close()
-        parentPipe.close()
-        iqChildPipe.close()
-        iqParentPipe.close()
+        print("")
+        print("Receiver stream: {} samples, {}".format(sdr.getStreamStats()['samples'], sdr.getStreamStatusString()))
+        if reader is not None:
+            print("Stream buffer: {}".format(reader.getStatusString()))
+        print("Image buffer: {}".format(imgRing.getStatusString()))
+        imgRing.close()
+        if iqRing is not None:
+            print("IQ buffer: {}".format(iqRing.getStatusString()))
+            iqRing.close()
 
         print("")
 
@@ -351,13 +655,14 @@ if __name__ == '__main__':
 
         # Combine files
         print("Images saved: {}".format(filesSavedCount))
-        print("IQ blocks saved: {}".format(iqSavedCount))
+        if iqTriggerStats is not None:
+            print("IQ blocks sent: {}, saved: {}Mb in {} events".format(iqSavedCount, int(iqTriggerStats[0]*2*iqFileBPS/8/(1024*1024)), iqTriggerStats[1]))
+        else:
+            print("IQ blocks saved: {}".format(iqSavedCount))
 
         if filesSavedCount > 1:
             fileProcessing.combineImages(imageFileName, filesSavedCount)
-        if iqSavedCount > 0:
-            fileProcessing.combineIQData(wavFileName, iqSavedCount, int(sampleRate/decimation), iqBPS)
 
         print("")
 
-
+    signalProcessing.saveFFTWisdom()